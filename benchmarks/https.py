@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''Load tests for scripts.https.
+
+A corpus of files with mixed sizes is served by sserv over loopback, and concurrent TLS clients download them for a
+fixed duration with and without keep-alive. The clients run in several processes so that they do not compete with each
+other for the GIL, and the server runs in its own process with metrics enabled. Results are written as JSON so that
+server configurations and commits can be compared.
+'''
+
+import http.client
+import json
+import multiprocessing
+import os
+import random
+import re
+import signal
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+from scripts import https
+
+# The size of each kind of file and how often it is requested
+sizes = {
+    '1k': (1024, 40),
+    '16k': (16 * 1024, 30),
+    '256k': (256 * 1024, 20),
+    '4m': (4 * 1024 * 1024, 10)
+}
+
+def generate_corpus(directory, files, seed=0):
+    '''Write `files` random files of each size to a directory.
+
+    :return: The path and weight of each file
+    :rtype: list
+    '''
+    generator = random.Random(seed)
+    paths = list()
+    for name, (size, weight) in sizes.items():
+        os.makedirs(os.path.join(directory, name), exist_ok=True)
+        for number in range(files):
+            with open(os.path.join(directory, name, '{}.bin'.format(number)), 'wb') as file:
+                file.write(generator.getrandbits(8 * size).to_bytes(size, 'little'))
+            paths.append(('/{}/{}.bin'.format(name, number), weight / files))
+    return paths
+
+def percentile(values, fraction):
+    return round(sorted(values)[min(len(values) - 1, int(len(values) * fraction))] * 1000, 3) if values else None
+
+def new_samples():
+    return {'latencies': list(), 'full': list(), 'resumed': list(), 'bytes': 0, 'errors': 0}
+
+def client(port, paths, deadline, keep_alive, seed, samples):
+    '''Request random paths until the deadline, reconnecting after every request unless keep-alive is on.
+    Reconnecting clients resume their previous TLS session.
+    '''
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    generator = random.Random(seed)
+    names, weights = zip(*paths)
+    connection, session = None, None
+    while time.perf_counter() < deadline:
+        try:
+            if connection is None:
+                start = time.perf_counter()
+                sock = context.wrap_socket(socket.create_connection(('127.0.0.1', port)), server_hostname='localhost', session=session)
+                samples['resumed' if sock.session_reused else 'full'].append(time.perf_counter() - start)
+                connection = http.client.HTTPConnection('127.0.0.1', port)
+                connection.sock = sock
+            start = time.perf_counter()
+            connection.request('GET', generator.choices(names, weights)[0], headers=dict() if keep_alive else {'Connection': 'close'})
+            response = connection.getresponse()
+            samples['bytes'] += len(response.read())
+            samples['latencies'].append(time.perf_counter() - start)
+            samples['errors'] += response.status != 200
+            if response.will_close or not keep_alive:
+                # TLS 1.3 session tickets arrive after the handshake, so the session is saved once a response is read
+                session = connection.sock.session
+                connection.close()
+                connection = None
+        except (OSError, http.client.HTTPException):
+            samples['errors'] += 1
+            if connection:
+                connection.close()
+            connection = None
+    if connection:
+        connection.close()
+
+def clients(port, paths, count, duration, keep_alive, seed):
+    '''Run `count` clients on threads in this process and merge their samples.'''
+    samples = new_samples()
+    deadline = time.perf_counter() + duration
+    results = [new_samples() for _ in range(count)]
+    threads = [threading.Thread(target=client, args=(port, paths, deadline, keep_alive, seed * 1000 + number, results[number])) for number in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for result in results:
+        for key in samples:
+            samples[key] += result[key]
+    return samples
+
+def serve(directory, keyfile, certfile, engine):
+    '''Start sserv in a new interpreter on an unused port.
+
+    :return: The server process and its port
+    :rtype: tuple
+    '''
+    command = [sys.executable, '-u', '-m', 'scripts.https', '--metrics', '-b', '127.0.0.1', '-c', certfile, '-d', directory, '-e', engine, '-k', keyfile, '-P', 'HTTP/1.1', '0']
+    server = subprocess.Popen(command, cwd=root, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    for line in server.stdout:
+        match = re.search(rb'^Serving HTTPS on \S+ port ([0-9]+)', line)
+        if match:
+            return server, int(match.group(1))
+    raise RuntimeError('sserv exited with {}'.format(server.wait()))
+
+def metrics(port):
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    connection = http.client.HTTPSConnection('127.0.0.1', port, context=context)
+    try:
+        connection.request('GET', https.MetricsMixIn.metrics_path)
+        return json.loads(connection.getresponse().read().decode('utf-8'))
+    finally:
+        connection.close()
+
+def run(directory, keyfile, certfile, paths, engine, keep_alive, count, processes, duration):
+    server, port = serve(directory, keyfile, certfile, engine)
+    try:
+        # Spread the clients over the processes as evenly as possible
+        counts = [count // processes + (number < count % processes) for number in range(min(count, processes))]
+        start = time.perf_counter()
+        with multiprocessing.Pool(len(counts)) as pool:
+            results = pool.starmap(clients, [(port, paths, number, duration, keep_alive, seed) for seed, number in enumerate(counts)])
+        elapsed = time.perf_counter() - start
+        server_metrics = metrics(port)
+    finally:
+        server.send_signal(signal.SIGINT)
+        server.wait()
+    samples = new_samples()
+    for result in results:
+        for key in samples:
+            samples[key] += result[key]
+    latencies = samples['latencies']
+    return {
+        'engine': engine,
+        'keep_alive': keep_alive,
+        'clients': count,
+        'seconds': elapsed,
+        'requests': len(latencies),
+        'errors': samples['errors'],
+        'requests_per_second': len(latencies) / elapsed,
+        'mb_per_second': samples['bytes'] / elapsed / 1024 / 1024,
+        'latency_ms': {'p50': percentile(latencies, 0.5), 'p99': percentile(latencies, 0.99), 'max': percentile(latencies, 1)},
+        # Client side handshake times include connecting, and the server's own times are in server.handshakes
+        'handshake_ms': {kind: {'count': len(samples[kind]), 'p50': percentile(samples[kind], 0.5), 'p99': percentile(samples[kind], 0.99)} for kind in ['full', 'resumed']},
+        'server': server_metrics
+    }
+
+def revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=root, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True).stdout.decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Load test sserv over loopback with concurrent TLS clients.')
+    parser.add_argument('-c', '--clients', default=32, type=int, help='Concurrent clients [default: 32]')
+    parser.add_argument('-d', '--duration', default=10, type=float, help='Seconds to run each load test [default: 10]')
+    parser.add_argument('-e', '--engine', action='append', choices=['async', 'threading'], help='Server engine to test, may be given more than once [default: both]')
+    parser.add_argument('-f', '--files', default=8, type=int, help='Files of each size to serve [default: 8]')
+    parser.add_argument('-k', '--keep-alive', choices=['on', 'off', 'both'], default='both', help='Whether clients reuse connections [default: both]')
+    parser.add_argument('-o', '--output', type=str, help='Write results to a file instead of standard output')
+    parser.add_argument('-p', '--processes', default=os.cpu_count(), type=int, help='Processes to run the clients in [default: all cores]')
+    args = parser.parse_args()
+    results = {'revision': revision(), 'python': sys.version.split()[0], 'openssl': ssl.OPENSSL_VERSION, 'sizes': sizes, 'benchmarks': list()}
+    with tempfile.TemporaryDirectory() as directory:
+        paths = generate_corpus(os.path.join(directory, 'www'), args.files)
+        keyfile, certfile = https.provision_credentials(directory=os.path.join(directory, 'tls'))
+        for engine in args.engine or ['threading', 'async']:
+            for keep_alive in {'on': [True], 'off': [False], 'both': [True, False]}[args.keep_alive]:
+                results['benchmarks'].append(run(os.path.join(directory, 'www'), keyfile, certfile, paths, engine, keep_alive, args.clients, args.processes, args.duration))
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(output + '\n')
+    else:
+        print(output)
+
+if __name__ == '__main__':
+    main()
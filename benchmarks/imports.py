@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''Import time benchmarks for the console scripts.
+
+Each entry point is imported the way its console script wrapper imports it, in a new interpreter, several times. The
+wall time of a bare interpreter is measured the same way so that it can be subtracted. Results are written as JSON and
+may be compared to a previous run to catch regressions.
+'''
+
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import time
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The module of each console script in setup.py
+entry_points = {
+    'bhq': 'scripts.bhquery',
+    'scan': 'scripts.scan',
+    'sserv': 'scripts.https',
+    'urlparse': 'scripts.urlparse'
+}
+# Dependencies that are slow to import and should only be imported by the scripts that need them
+dependencies = ['cryptography', 'neo4j', 'rich']
+
+def exports():
+    '''Get the modules whose __all__, without main, differs from the names the package lazily exports for them.'''
+    import importlib
+    sys.path.insert(0, root)
+    import scripts
+    return [module for module, names in scripts._exports.items() if names != [name for name in importlib.import_module('scripts.' + module).__all__ if name != 'main']]
+
+def measure(statement, repeat):
+    '''Run a statement in new interpreters and measure their wall times in milliseconds.'''
+    times = list()
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', statement], cwd=root, check=True)
+        times.append((time.perf_counter() - start) * 1000)
+    return times
+
+def profile(module):
+    '''Get the cumulative import time of a module in milliseconds and the slow dependencies it imports.'''
+    statement = 'import json, sys; from {} import main; print(json.dumps(sorted(set(sys.modules) & set({!r}))))'.format(module, dependencies)
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', statement], cwd=root, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+    # Only the top level imports of the package are counted, because their times include the imports they make
+    cumulative = re.findall(r'(?m)^import time:\s+\d+ \|\s+(\d+) \| scripts(?:\.\S+)?$', process.stderr.decode('utf-8'))
+    return sum(map(int, cumulative)) / 1000, json.loads(process.stdout.decode('utf-8'))
+
+def revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=root, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True).stdout.decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Benchmark the import time of each console script.')
+    parser.add_argument('-c', '--compare', metavar='FILE', help='Exit with an error if an entry point is slower than in a previous result file')
+    parser.add_argument('-o', '--output', type=str, help='Write results to a file instead of standard output')
+    parser.add_argument('-r', '--repeat', default=20, type=int, help='Interpreters to start for each entry point [default: 20]')
+    parser.add_argument('-t', '--tolerance', default=25.0, type=float, help='Percent an entry point may be slower than the compared result [default: 25]')
+    args = parser.parse_args()
+    mismatched = exports()
+    for module in mismatched:
+        print('The package exports different names than scripts.{}.__all__'.format(module), file=sys.stderr)
+    if mismatched:
+        sys.exit(1)
+    interpreter = statistics.median(measure('pass', args.repeat))
+    results = {'revision': revision(), 'python': sys.version.split()[0], 'interpreter_ms': interpreter, 'benchmarks': {}}
+    for name, module in entry_points.items():
+        times = measure('from {} import main'.format(module), args.repeat)
+        import_ms, imported = profile(module)
+        results['benchmarks'][name] = {
+            'module': module,
+            'median_ms': statistics.median(times) - interpreter,
+            'min_ms': min(times) - interpreter,
+            # The time Python reports for importing the package and module, which is less noisy than the wall time
+            'import_ms': import_ms,
+            'dependencies': imported
+        }
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(output + '\n')
+    else:
+        print(output)
+    if args.compare:
+        with open(args.compare) as file:
+            previous = json.load(file)['benchmarks']
+        regressions = [name for name, result in results['benchmarks'].items() if name in previous and result['import_ms'] > previous[name]['import_ms'] * (1 + args.tolerance / 100)]
+        for name in regressions:
+            print('{} imports in {:.1f} ms instead of {:.1f} ms'.format(name, results['benchmarks'][name]['import_ms'], previous[name]['import_ms']), file=sys.stderr)
+        sys.exit(1 if regressions else 0)
+
+if __name__ == '__main__':
+    main()
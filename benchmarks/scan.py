@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''Throughput benchmarks for scripts.scan.
+
+Synthetic corpora are generated in a temporary directory and each benchmark is run in a new interpreter so that its
+peak RSS can be measured. Results are written as JSON so that they can be compared between commits.
+'''
+
+import bz2, gzip, lzma
+import io
+import json
+import os
+import random
+import re
+import resource
+import subprocess
+import sys
+import tarfile, zipfile
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from scripts import scan
+
+samples = {
+    'email': lambda random: 'user{}@example{}.com'.format(random.randrange(10**6), random.randrange(100)),
+    'domain_name': lambda random: 'host{}.example.org'.format(random.randrange(10**6)),
+    'imei': lambda random: ''.join(random.choice('0123456789') for _ in range(15)),
+    'ipv4_address': lambda random: '.'.join(str(random.randrange(256)) for _ in range(4)),
+    'ipv6_address': lambda random: ':'.join('{:x}'.format(random.randrange(65536)) for _ in range(8)),
+    'mac_address': lambda random: ':'.join('{:02x}'.format(random.randrange(256)) for _ in range(6)),
+    'us_phone_number': lambda random: '{}-555-{:04d}'.format(random.randint(200, 999), random.randrange(10000))
+}
+filler = 'lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt ut labore'.split()
+
+def generate_text(size, density, seed=0):
+    '''Generate log lines with roughly `density` identifiers per KiB.
+
+    :param size: The number of characters to generate
+    :type size: int
+    :param density: The number of identifiers per KiB
+    :type density: float
+    :param seed: A seed for the random number generator
+    :type seed: int, optional
+    :return: The generated text
+    :rtype: str
+    '''
+    generator = random.Random(seed)
+    lines, length = list(), 0
+    while length < size:
+        words = [generator.choice(filler) for _ in range(generator.randint(4, 16))]
+        line = ' '.join(words)
+        # Add identifiers in proportion to the line length
+        for _ in range(int(len(line) * density / 1024 + generator.random())):
+            words.insert(generator.randrange(len(words) + 1), samples[generator.choice(list(samples))](generator))
+        line = ' '.join(words)
+        lines.append(line)
+        length += len(line) + 1
+    return '\n'.join(lines) + '\n'
+
+def generate_binary(size, density, seed=0):
+    '''Generate random bytes with identifiers embedded at roughly `density` identifiers per KiB.'''
+    generator = random.Random(seed)
+    data = bytearray(generator.getrandbits(8 * size).to_bytes(size, 'little'))
+    for _ in range(int(size * density / 1024)):
+        sample = samples[generator.choice(list(samples))](generator).encode('utf-8')
+        position = generator.randrange(max(1, size - len(sample)))
+        data[position:position + len(sample)] = sample
+    return bytes(data)
+
+def generate_corpus(root, size, density, files, depth):
+    '''Write every corpus the benchmarks use to a directory.
+
+    :return: The paths of each corpus, keyed by name
+    :rtype: dict
+    '''
+    text = generate_text(size, density).encode('utf-8')
+    paths = {
+        'text': os.path.join(root, 'text.log'),
+        'binary': os.path.join(root, 'binary.dat'),
+        'gzip': os.path.join(root, 'text.log.gz'),
+        'bzip2': os.path.join(root, 'text.log.bz2'),
+        'xz': os.path.join(root, 'text.log.xz'),
+        'tar': os.path.join(root, 'archive.tar.gz'),
+        'zip': os.path.join(root, 'archive.zip'),
+        'tree': os.path.join(root, 'tree')
+    }
+    with open(paths['text'], 'wb') as file:
+        file.write(text)
+    with open(paths['binary'], 'wb') as file:
+        file.write(generate_binary(size, density))
+    for name, module in [('gzip', gzip), ('bzip2', bz2), ('xz', lzma)]:
+        with module.open(paths[name], 'wb') as file:
+            file.write(text)
+    # Archives and the directory tree hold many small files
+    members = [generate_text(max(1, size // files), density, seed).encode('utf-8') for seed in range(files)]
+    with tarfile.open(paths['tar'], 'w:gz') as archive:
+        for number, member in enumerate(members):
+            info = tarfile.TarInfo('member{}.log'.format(number))
+            info.size = len(member)
+            archive.addfile(info, io.BytesIO(member))
+    with zipfile.ZipFile(paths['zip'], 'w', zipfile.ZIP_DEFLATED) as archive:
+        for number, member in enumerate(members):
+            archive.writestr('member{}.log'.format(number), member)
+    for number, member in enumerate(members):
+        directory = os.path.join(paths['tree'], *['level{}'.format(level) for level in range(number % (depth + 1))])
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, 'member{}.log'.format(number)), 'wb') as file:
+            file.write(member)
+    return paths
+
+def measure(function, path, terms, binary=False, jobs=1):
+    '''Run a scan function and measure its throughput. This is meant to be run in a new interpreter.'''
+    regexes = {term: re.compile(scan.identifiers[term].encode('utf-8') if binary else scan.identifiers[term], re.MULTILINE) for term in terms}
+    files, size, hits = 0, 0, 0
+    def report(subject, results, binary=False):
+        nonlocal files, hits
+        hits += sum(1 for _ in results)
+        files += 1
+    if os.path.isdir(path):
+        for root, _, names in os.walk(path):
+            size += sum(os.path.getsize(os.path.join(root, name)) for name in names)
+    else:
+        size = os.path.getsize(path)
+    start = time.perf_counter()
+    if function == 'directory':
+        # Workers return their hits to the reporter, so the report still sees every file
+        scan.directory(path, regexes, recursive=True, jobs=jobs, report=report)
+    elif function == 'archive':
+        scan.archive(path, regexes, report=report)
+    else:
+        scan.file(path, regexes, report=report)
+    elapsed = time.perf_counter() - start
+    return {
+        'seconds': elapsed,
+        'bytes': size,
+        'mb_per_second': size / elapsed / 1024 / 1024 if elapsed else None,
+        'files': files,
+        'files_per_second': files / elapsed if elapsed else None,
+        'hits': hits,
+        # ru_maxrss is in KiB on Linux and bytes on macOS. Children are parallel workers
+        'peak_rss': max(resource.getrusage(_).ru_maxrss for _ in [resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN]) * (1 if sys.platform == 'darwin' else 1024)
+    }
+
+def run(function, path, terms, binary=False, jobs=1):
+    arguments = json.dumps([function, path, terms, binary, jobs])
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), '--measure', arguments], stdout=subprocess.PIPE, check=True).stdout
+    return json.loads(output.decode('utf-8'))
+
+def revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)), stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True).stdout.decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Benchmark file, directory, and archive scanning.')
+    parser.add_argument('-d', '--density', default=1.0, type=float, help='Identifiers per KiB of generated data [default: 1.0]')
+    parser.add_argument('-f', '--files', default=500, type=int, help='Files in the generated archives and directory tree [default: 500]')
+    parser.add_argument('-j', '--jobs', default=os.cpu_count(), type=int, help='Workers for the parallel directory benchmark [default: all cores]')
+    parser.add_argument('-l', '--levels', default=8, type=int, help='Depth of the generated directory tree [default: 8]')
+    parser.add_argument('-o', '--output', type=str, help='Write results to a file instead of standard output')
+    parser.add_argument('-s', '--size', default=32, type=int, help='Size of each generated file in MiB [default: 32]')
+    parser.add_argument('--measure', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.measure:
+        return print(json.dumps(measure(*json.loads(args.measure))))
+    terms = [term for term in scan.identifiers if term != 'words']
+    results = {'revision': revision(), 'python': sys.version.split()[0], 'size': args.size, 'density': args.density, 'benchmarks': {}}
+    benchmarks = results['benchmarks']
+    with tempfile.TemporaryDirectory() as root:
+        paths = generate_corpus(root, args.size * 1024 * 1024, args.density, args.files, args.levels)
+        for name in ['text', 'gzip', 'bzip2', 'xz']:
+            benchmarks['file.{}'.format(name)] = run('file', paths[name], terms)
+        benchmarks['file.binary'] = run('file', paths['binary'], terms, binary=True)
+        for term in terms:
+            benchmarks['identifier.{}'.format(term)] = run('file', paths['text'], [term])
+        for name in ['tar', 'zip']:
+            benchmarks['archive.{}'.format(name)] = run('archive', paths[name], terms)
+        benchmarks['directory.serial'] = run('directory', paths['tree'], terms)
+        benchmarks['directory.parallel'] = run('directory', paths['tree'], terms, jobs=args.jobs)
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(output + '\n')
+    else:
+        print(output)
+
+if __name__ == '__main__':
+    main()
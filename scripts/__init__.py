@@ -3,7 +3,31 @@
 __version__ = '1.1'
 __author__ = 'Evan McBroom'
 
-from .bhquery import *
-from .https import *
-from .scan import *
-from .urlparse import *
\ No newline at end of file
+import importlib as _importlib
+
+# The module each public name is imported from. Modules, and dependencies such as neo4j, are only imported when one of
+# their names is first used, so each console script only pays for its own module. The names are the __all__ of each
+# module without main, which benchmarks/imports.py checks, and main is from urlparse because it was the last module to
+# be star imported.
+_exports = {
+    'bhquery': ['BloodHoundDatabase', 'QueryCache', 'export', 'get_batches', 'get_names'],
+    'https': ['AsyncHTTPSServer', 'CachingHTTPRequestHandler', 'HandshakeCounters', 'HTTPSServer', 'MetricsMixIn', 'ResponseCache', 'ServerMetrics', 'ThreadingHTTPSServer', 'create_context', 'provision_credentials'],
+    'scan': ['Index', 'Writer', 'archive', 'directory', 'file', 'open_uncompressed'],
+    'urlparse': ['code', 'encode', 'encode_many', 'decode', 'decode_many']
+}
+_modules = {name: module for module, names in _exports.items() for name in names}
+_modules['main'] = 'urlparse'
+
+__all__ = list(_modules)
+
+def __getattr__(name):
+    if name in _exports:
+        return _importlib.import_module('.' + name, __name__)
+    if name in _modules:
+        value = getattr(_importlib.import_module('.' + _modules[name], __name__), name)
+        globals()[name] = value
+        return value
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__) | set(_exports))
@@ -4,44 +4,254 @@
 '''BloodHound legacy database class.'''
 
 __all__ = [
-    'BloodHoundDatabase', 'get_names', 'main'
+    'BloodHoundDatabase', 'QueryCache', 'export', 'get_batches', 'get_names', 'main'
 ]
 
+import collections
+import csv
+import itertools
+import json
 import neo4j
+import re
 import sys
+import threading
+
+class QueryCache:
+    '''A thread safe LRU cache of query results. Each clear starts a new generation, so that results of queries that
+    started before the cache was cleared are not cached.
+    '''
+    def __init__(self, size=32):
+        self.size = size
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.generation = 0
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.generation += 1
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+
+    def put(self, key, value, generation=None):
+        with self.lock:
+            if self.size <= 0 or generation not in [None, self.generation]:
+                return
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
 
 class BloodHoundDatabase(neo4j.GraphDatabase):
-    def __init__(self, uri, username, password):
+    # Legacy BloodHound adds the Base or AZBase label to every node it imports
+    fulltext_index = 'bhq_find'
+    fulltext_labels = ['Base', 'AZBase']
+    fulltext_properties = ['name', 'displayname', 'description', 'distinguishedname', 'email', 'samaccountname', 'objectid', 'operatingsystem', 'title']
+
+    def __init__(self, uri, username, password, cache_size=0):
         super().__init__()
+        self.cache = QueryCache(cache_size)
         self.connected = False
+        # Each thread reuses one session instead of opening a session per query
+        self.sessions = threading.local()
         self.reconnect(uri, username, password)
         
     __list = lambda self, attribute, dry_run=False: self.query('MATCH (node {%s: true}) RETURN node.name' % (attribute), dry_run)
-    __set = lambda self, name, attribute, value, dry_run: self.query('MATCH (node {name: \'%s\'}) SET node.%s = %s, node.manuallyset = true RETURN COUNT(*) AS count' % (name, attribute, value), dry_run)
-    find = lambda self, value, dry_run=False: self.query('MATCH (node) where (any(attribute in keys(node) where node[attribute] =~ \'.*%s.*\')) RETURN node' % (value), dry_run)
+    __set = lambda self, name, attribute, value, dry_run: self.__set_batch([name], [attribute], value, dry_run)
+    # Attribute names can not be parameterized but they are never user input
+    __set_batch = lambda self, names, attributes, value, dry_run: self.write('UNWIND $names AS name MATCH (node {name: name}) SET %s, node.manuallyset = true RETURN COUNT(*) AS count' % (', '.join('node.%s = $value' % (attribute) for attribute in attributes)), {'names': names, 'value': value}, dry_run)
     list_high_value = lambda self, dry_run=False: self.__list('highvalue', dry_run)
     list_owned = lambda self, dry_run=False: self.__list('owned', dry_run)
-    set_high_value = lambda self, name, status=True, dry_run=False: self.__set(name, 'highvalue', 'true' if status else 'false', dry_run)
-    set_owned = lambda self, name, status=True, dry_run=False: self.__set(name, 'owned', 'true' if status else 'false', dry_run)
+    set_high_value = lambda self, name, status=True, dry_run=False: self.__set(name, 'highvalue', bool(status), dry_run)
+    set_owned = lambda self, name, status=True, dry_run=False: self.__set(name, 'owned', bool(status), dry_run)
+
+    def set_batch(self, names, high_value=False, owned=False, status=True, dry_run=False):
+        '''Mark a batch of nodes as high value, owned, or both in one query.
+
+        :param names: The names of the nodes
+        :type names: list
+        :raises ValueError: If neither high_value nor owned is set
+        '''
+        attributes = [attribute for attribute, selected in [('highvalue', high_value), ('owned', owned)] if selected]
+        if not attributes:
+            raise ValueError('At least one of high_value or owned must be set')
+        return self.__set_batch(list(names), attributes, bool(status), dry_run)
+
+    def create_fulltext_index(self, timeout=300):
+        '''Create the full-text index that `find` uses if it does not exist and wait for it to come online.
 
-    def query(self, cypher, dry_run=False):
+        :param timeout: The number of seconds to wait for the index to be populated
+        :type timeout: int, optional
+        :return: An error message or None if the index is online
+        :rtype: str
+        '''
+        output = self.query('CREATE FULLTEXT INDEX %s IF NOT EXISTS FOR (node:%s) ON EACH [%s]' % (self.fulltext_index, '|'.join(self.fulltext_labels), ', '.join('node.' + _ for _ in self.fulltext_properties)))
+        if type(output) == list:
+            output = self.query('CALL db.awaitIndex($index, $timeout)', parameters={'index': self.fulltext_index, 'timeout': timeout})
+        return None if type(output) == list else output
+
+    def find(self, value, dry_run=False, exhaustive=False, page=0, page_size=100):
+        '''Search for nodes with a property value that contains a value.
+        A full-text index is used by default. The exhaustive search matches the value as a regex against every property
+        of every node instead, which is slow on large databases. The index's standard analyzer splits values on
+        punctuation, such as the @ and . in user names, so words that include punctuation are searched for by their parts
+        and then matched as a whole. The index is created by the first search, and if it can not be, such as without
+        schema privileges or before Neo4j 4.3, every search is exhaustive.
+
+        :param value: The value to search for
+        :type value: str
+        :param exhaustive: Search every property of every node instead of using the full-text index
+        :type exhaustive: bool, optional
+        :param page: The page of results to return
+        :type page: int, optional
+        :param page_size: The number of results per page
+        :type page_size: int, optional
+        :return: The matching nodes or an error message
+        :rtype: list
+        '''
+        parameters = {'skip': page * page_size, 'limit': page_size}
+        parts = [part for part in re.split(r'\W+', value) if part]
+        if parts and not exhaustive and not dry_run and self.fulltext_online is None:
+            error = self.create_fulltext_index()
+            self.fulltext_online = not error
+            if error:
+                print('Searching every node because the full-text index could not be created: {}'.format(error), file=sys.stderr)
+        if exhaustive or not parts or self.fulltext_online is False:
+            return self.query('MATCH (node) WHERE any(attribute IN keys(node) WHERE node[attribute] =~ $pattern) RETURN node SKIP $skip LIMIT $limit', dry_run, dict(parameters, pattern='.*%s.*' % (value)))
+        # Match each part of the value anywhere in a token. Parts are word characters, so they have no Lucene syntax
+        search = ' AND '.join('*%s*' % (part) for part in parts)
+        words = [word.lower() for word in value.split() if re.search(r'\W', word)]
+        if not words:
+            return self.query('CALL db.index.fulltext.queryNodes($index, $search) YIELD node RETURN node SKIP $skip LIMIT $limit', dry_run, dict(parameters, index=self.fulltext_index, search=search))
+        # Nodes that have all of the parts are filtered to those with a property that contains each word like the index would
+        return self.query('CALL db.index.fulltext.queryNodes($index, $search) YIELD node WITH node WHERE all(word IN $words WHERE any(property IN $properties WHERE toLower(node[property]) CONTAINS word)) RETURN node SKIP $skip LIMIT $limit', dry_run, dict(parameters, index=self.fulltext_index, search=search, words=words, properties=self.fulltext_properties))
+
+    def query(self, cypher, dry_run=False, parameters=None):
         if dry_run:
-            return 'Query: ' + cypher
+            return 'Query: ' + cypher + (' Parameters: {}'.format(parameters) if parameters else '')
         else:
-            with self.driverInstance.session() as session:
-                try:
-                    return session.run(cypher).data()
-                except neo4j.exceptions.Neo4jError as error:
-                    return error.message
-                except neo4j.exceptions.ServiceUnavailable:
-                    return 'Could not connect to database.'
-                except ValueError as error:
-                    return 'You must provide a query to run.'
+            key = (cypher, json.dumps(parameters, sort_keys=True, default=str))
+            output = self.cache.get(key)
+            if output is not None:
+                return output
+            generation = self.cache.generation
+            try:
+                result = self.session().run(cypher, parameters)
+                output = result.data()
+                # Results are only cached for queries that did not change the database, which invalidate the cache
+                if result.consume().counters.contains_updates:
+                    self.cache.clear()
+                else:
+                    self.cache.put(key, output, generation)
+                return output
+            except neo4j.exceptions.Neo4jError as error:
+                return error.message
+            except neo4j.exceptions.ServiceUnavailable:
+                self.close_session()
+                return 'Could not connect to database.'
+            except ValueError as error:
+                return 'You must provide a query to run.'
+
+    def session(self):
+        '''Get the current thread's session, which is opened the first time it is used.'''
+        if getattr(self.sessions, 'session', None) is None:
+            self.sessions.session = self.driverInstance.session()
+        return self.sessions.session
+
+    def close_session(self):
+        '''Close the current thread's session so that a new one is opened for the next query.'''
+        if getattr(self.sessions, 'session', None) is not None:
+            self.sessions.session.close()
+            self.sessions.session = None
+
+    def stream(self, cypher, parameters=None, fetch_size=1000):
+        '''Generate the records of a query as the driver fetches them instead of loading the entire result.
+
+        :param cypher: A query to run
+        :type cypher: str
+        :param parameters: Query parameters
+        :type parameters: dict, optional
+        :param fetch_size: The number of records to fetch from the database at a time
+        :type fetch_size: int, optional
+        :return: A yielded record
+        :rtype: dict
+        '''
+        with self.driverInstance.session(fetch_size=fetch_size) as session:
+            for record in session.run(cypher, parameters):
+                yield record.data()
+
+    def write(self, cypher, parameters=None, dry_run=False):
+        '''Run a query in a managed write transaction, which is retried if the database reports a transient error.'''
+        if dry_run:
+            return 'Query: ' + cypher + (' Parameters: {}'.format(parameters) if parameters else '')
+        else:
+            session = self.session()
+            # Drivers before 5.0 name managed transactions differently
+            execute = session.execute_write if hasattr(session, 'execute_write') else session.write_transaction
+            try:
+                return execute(lambda transaction: transaction.run(cypher, parameters).data())
+            except neo4j.exceptions.Neo4jError as error:
+                return error.message
+            except neo4j.exceptions.ServiceUnavailable:
+                self.close_session()
+                return 'Could not connect to database.'
+            finally:
+                # Cached results may be stale once a write is attempted, including those of queries that ran during it
+                self.cache.clear()
                 
     def reconnect(self, uri, username='', password=''):
+        self.close_session()
+        self.cache.clear()
+        # Whether the full-text index is online is unknown until find first tries to create it
+        self.fulltext_online = None
         self.driverInstance = self.driver(uri, auth = neo4j.Auth(scheme='basic', principal=username, credentials=password))
         self.connected = True
 
+def export(records, format, file):
+    '''Write records to a file as they are generated, as newline delimited JSON or CSV.
+    CSV columns are taken from the first record and nested values are written as JSON.
+
+    :param records: An iterable of records
+    :type records: iterable
+    :param format: Either ndjson or csv
+    :type format: str
+    :param file: A text file object to write to
+    :type file: file object
+    :return: The number of records written
+    :rtype: int
+    '''
+    count, writer = 0, None
+    for count, record in enumerate(records, 1):
+        if format == 'ndjson':
+            file.write(json.dumps(record, default=str) + '\n')
+        else:
+            if not writer:
+                writer = csv.DictWriter(file, fieldnames=list(record.keys()), extrasaction='ignore')
+                writer.writeheader()
+            writer.writerow({key: json.dumps(value, default=str) if type(value) in [dict, list] else value for key, value in record.items()})
+    return count
+
+def get_batches(names, size=1000):
+    '''Group names into lists so that they can be sent to the database together.
+
+    :param names: An iterable of names
+    :type names: iterable
+    :param size: The maximum number of names in a batch
+    :type size: int, optional
+    :return: A yielded batch of names
+    :rtype: list
+    '''
+    names = iter(names)
+    while True:
+        batch = list(itertools.islice(names, size))
+        if not batch:
+            return
+        yield batch
+
 def get_names(names):
     '''Generate a list or names from a comma separated list or stdin if no list is given.
 
@@ -59,16 +269,26 @@ def get_names(names):
 
 def main():
     import argparse
+    import concurrent.futures
     import getpass
     import readline # implicitly used by rich.Console.input
     import rich
     import rich.console
+    import rich.markup
 
     parser = argparse.ArgumentParser(description='Query or modify a BloodHound database.')
     parser.add_argument('-d', '--dry-run', action='store_true', help='Show changes required to apply markings')
     parser.add_argument('-p', '--password', nargs='?', const=True, type=str, help='Connection password [default: prompt user]')
     parser.add_argument('-u', '--uri', default='bolt://localhost:7687', type=str, help='Specify alternate port [default: bolt://localhost:7687]')
     parser.add_argument('--username', default='neo4j', type=str, help='Connection username [default: neo4j]')
+    parser.add_argument('-e', '--exhaustive', action='store_true', help='Search every property of every node instead of the full-text index')
+    parser.add_argument('--page', default=0, type=int, help='Page of search results to show [default: 0]')
+    parser.add_argument('--page-size', default=100, type=int, help='Search results per page [default: 100]')
+    parser.add_argument('--cache-size', default=32, type=int, help='Query results to cache in the interactive shell [default: 32]')
+    parser.add_argument('--jobs', default=4, type=int, help='Background queries to run at once in the interactive shell [default: 4]')
+    parser.add_argument('--batch-size', default=1000, type=int, help='Names to mark per query [default: 1000]')
+    parser.add_argument('--fetch-size', default=1000, type=int, help='Records to fetch at a time when writing query output [default: 1000]')
+    parser.add_argument('--output', nargs=2, metavar=('FORMAT', 'FILE'), help='Stream query results to a file (- for stdout) as ndjson or csv')
     group = parser.add_mutually_exclusive_group()
     group.add_argument('-f', '--find', metavar='VALUE', type=str, help='Search for a node with an attribute value')
     group.add_argument('-l', '--list', action='store_true', help='List all owned and high value nodes')
@@ -79,38 +299,72 @@ def main():
     group.add_argument('-o', '--owned', action='store_true', help='List or set nodes as owned')
     group.add_argument('-v', '--high-value', action='store_true', help='List or set nodes as high value')
     args = parser.parse_args()
+    if args.output and args.output[0] not in ['csv', 'ndjson']:
+        parser.error('unsupported output format: {}'.format(args.output[0]))
     password = getpass.getpass(prompt='Password: ') if not args.password or type(args.password) == bool else args.password
     database = BloodHoundDatabase(args.uri, username=args.username, password=password)
 
     print = lambda output: rich.console.Console().print(output)
     if database.connected:
         if args.find:
-            print(database.find(args.find, args.dry_run))
+            print(database.find(args.find, args.dry_run, args.exhaustive, args.page, args.page_size))
         elif args.list:
             if args.high_value or not args.owned:
                 print(database.list_high_value(args.dry_run))
             if args.owned or not args.high_value:
                 print(database.list_owned(args.dry_run))
+        elif args.query and args.output and not args.dry_run:
+            format, path = args.output
+            # Rows are written as they arrive, so output is buffered but never held in memory as a whole
+            with (open(sys.stdout.fileno(), 'w', buffering=1024 * 1024, newline='', closefd=False) if path == '-' else open(path, 'w', buffering=1024 * 1024, newline='')) as file:
+                try:
+                    count = export(database.stream(args.query, fetch_size=args.fetch_size), format, file)
+                except neo4j.exceptions.Neo4jError as error:
+                    return print(error.message)
+                except neo4j.exceptions.ServiceUnavailable:
+                    return print('Could not connect to database.')
+            rich.console.Console(stderr=True).print('Wrote {} records'.format(count))
         elif args.query:
             print(database.query(args.query, args.dry_run))
         elif any(_ in [type(args.set), type(args.reset)] for _ in (bool, str)):
             status = True if args.set else False
             argument = args.set if args.set else args.reset
-            for name in get_names(argument if type(argument) == str else ''):
-                if args.high_value or not args.owned:
-                    print(database.set_high_value(name, status, args.dry_run))
-                if args.owned or not args.high_value:
-                    print(database.set_owned(name, status, args.dry_run))
+            names = (name for name in get_names(argument if type(argument) == str else '') if name)
+            for number, batch in enumerate(get_batches(names, args.batch_size)):
+                output = database.set_batch(batch, args.high_value or not args.owned, args.owned or not args.high_value, status, args.dry_run)
+                print('Batch {}: {}'.format(number, '{} of {} names marked'.format(output[0]['count'], len(batch)) if type(output) == list else output))
         else:
+            # Results are only cached in the shell, where the same queries are often run again
+            database.cache = QueryCache(args.cache_size)
             console = rich.console.Console()
-            queryNumber = 0
-            while True:
-                output = database.query(console.input('In [{}]: '.format(queryNumber)))
+            def show(queryNumber, output):
                 successful = type(output) == list
                 console.print('Out[{}]:{}'.format(queryNumber, '' if successful else ('\n{}' if '\n' in output else ' {}').format(output)))
                 if successful:
                     console.print(output)
-                queryNumber += 1
+            # Queries that end with & run in the background and their output is shown before a later prompt
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs)
+            jobs = dict()
+            queryNumber = 0
+            try:
+                while True:
+                    for number, (cypher, job) in list(jobs.items()):
+                        if job.done():
+                            show(number, job.result())
+                            del jobs[number]
+                    cypher = console.input('In [{}]: '.format(queryNumber)).strip()
+                    if cypher == 'jobs':
+                        for number, (command, job) in sorted(jobs.items()):
+                            console.print('Job {} ({}): {}'.format(number, 'running' if job.running() else 'queued', rich.markup.escape(command)))
+                        continue
+                    if cypher.endswith('&'):
+                        jobs[queryNumber] = (cypher[:-1].strip(), executor.submit(database.query, cypher[:-1].strip()))
+                        console.print('Job {} started'.format(queryNumber))
+                    else:
+                        show(queryNumber, database.query(cypher))
+                    queryNumber += 1
+            finally:
+                executor.shutdown(wait=False)
     else:
         print('Could not connect to database at {}'.format(args.uri))
 
@@ -4,69 +4,743 @@
 '''HTTPs server classes.'''
 
 __all__ = [
-    'HTTPSServer', 'ThreadingHTTPSServer', 'main'
+    'AsyncHTTPSServer', 'CachingHTTPRequestHandler', 'HandshakeCounters', 'HTTPSServer', 'MetricsMixIn', 'ResponseCache',
+    'ServerMetrics', 'ThreadingHTTPSServer', 'create_context', 'main', 'provision_credentials'
 ]
 
-import OpenSSL
+import asyncio
+import bisect
+import collections
+import concurrent.futures
+import datetime
+import email.utils
+import functools
+import gzip
+import hashlib
+import http
 import http.server
+import io
+import json
+import os
+import re
 import socket
 import socketserver
 import ssl
 import sys
-import tempfile
+import threading
+import time
+import urllib.parse
+
+class HandshakeCounters:
+    '''Thread safe counts of the full, resumed, and failed TLS handshakes of a server and the seconds spent on them.'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = collections.Counter()
+        self.seconds = collections.Counter()
+
+    def __str__(self):
+        return ', '.join('{} {}'.format(value, key) for key, value in self.snapshot().items())
+
+    def failed(self):
+        with self.lock:
+            self.counts['failed'] += 1
+
+    def record(self, ssl_object, start=None):
+        '''Count a completed handshake. It is timed from when the server received the client hello if the context was
+        made by `create_context`, otherwise from `start`.
+
+        :param ssl_object: The TLS connection
+        :type ssl_object: class:`ssl.SSLSocket` or class:`ssl.SSLObject`
+        :param start: The value of `time.perf_counter()` when the handshake started
+        :type start: float, optional
+        '''
+        end = time.perf_counter()
+        start = getattr(ssl_object, 'handshake_started', start)
+        kind = 'resumed' if ssl_object.session_reused else 'full'
+        with self.lock:
+            self.counts[kind] += 1
+            if start is not None:
+                self.seconds[kind] += end - start
+
+    def snapshot(self):
+        '''Get the counts and average handshake times in milliseconds.
+
+        :rtype: dict
+        '''
+        with self.lock:
+            snapshot = {kind: self.counts[kind] for kind in ['full', 'resumed', 'failed']}
+            for kind in ['full', 'resumed']:
+                snapshot['{}_ms'.format(kind)] = round(self.seconds[kind] / self.counts[kind] * 1000, 3) if self.counts[kind] else None
+        return snapshot
+
+class ServerMetrics:
+    '''Thread safe counts of the connections, requests, and bytes a server has served, with a latency histogram per path.'''
+    # Upper bounds of the latency histogram buckets in milliseconds
+    buckets = [1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, float('inf')]
+    # Requests for paths beyond this many are counted together so that the metrics stay small
+    paths = 1024
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.active = 0
+        self.counts = collections.Counter()
+        self.statuses = collections.Counter()
+        self.latencies = dict()
+
+    def connected(self):
+        with self.lock:
+            self.active += 1
+            self.counts['connections'] += 1
+
+    def disconnected(self):
+        with self.lock:
+            self.active -= 1
+
+    def request(self, path, seconds, status=None):
+        bucket = bisect.bisect_left(self.buckets, seconds * 1000)
+        with self.lock:
+            self.counts['requests'] += 1
+            self.statuses[status] += 1
+            if path not in self.latencies and len(self.latencies) >= self.paths:
+                path = '(other)'
+            latency = self.latencies.setdefault(path, {'count': 0, 'seconds': 0.0, 'histogram': [0] * len(self.buckets)})
+            latency['count'] += 1
+            latency['seconds'] += seconds
+            latency['histogram'][bucket] += 1
+
+    def sent(self, size):
+        with self.lock:
+            self.counts['bytes_sent'] += size
+
+    def snapshot(self):
+        '''Get the metrics. Histograms count the requests that took at most each bucket's milliseconds and more than
+        the previous bucket's.
+
+        :rtype: dict
+        '''
+        labels = ['+Inf' if bound == float('inf') else '{:g}'.format(bound) for bound in self.buckets]
+        with self.lock:
+            return {
+                'active_connections': self.active,
+                'connections': self.counts['connections'],
+                'requests': self.counts['requests'],
+                'bytes_sent': self.counts['bytes_sent'],
+                'statuses': {str(status): count for status, count in self.statuses.items()},
+                'paths': {path: {
+                    'count': latency['count'],
+                    'mean_ms': round(latency['seconds'] / latency['count'] * 1000, 3),
+                    'histogram': dict(zip(labels, latency['histogram']))
+                } for path, latency in self.latencies.items()}
+            }
+
+class MetricsMixIn:
+    '''Mix-in for request handlers that records the latency of each request in the server's `ServerMetrics` and
+    serves the metrics of the server as JSON from `metrics_path`.
+    '''
+    metrics_path = '/__metrics'
+
+    def setup(self):
+        super().setup()
+        # The async server counts the bytes it writes itself, and does not run this
+        self.wfile = _CountingWriter(self.wfile, self.server.metrics)
+
+    def do_GET(self):
+        if urllib.parse.urlsplit(self.path).path != self.metrics_path:
+            return super().do_GET()
+        metrics = self.server.metrics.snapshot()
+        metrics['handshakes'] = self.server.handshakes.snapshot()
+        if isinstance(getattr(self, 'cache', None), ResponseCache):
+            with self.cache.lock:
+                metrics['cache'] = dict(self.cache.counts, files=len(self.cache.entries), size=self.cache.used)
+        body = json.dumps(metrics, indent=2).encode('utf-8')
+        self.send_response(http.HTTPStatus.OK)
+        self.send_header('Content-type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'no-store')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def handle_one_request(self):
+        self.started = None
+        super().handle_one_request()
+        if self.started is not None:
+            path, status = urllib.parse.urlsplit(getattr(self, 'path', '')).path, getattr(self, 'status', None)
+            # The async server sends the response after the handler returns, so it records the request once it is sent
+            if isinstance(self.wfile, _Response):
+                self.wfile.timing = (path, self.started, status)
+            else:
+                self.server.metrics.request(path, time.perf_counter() - self.started, status)
+
+    def parse_request(self):
+        # Start timing once the request line is read, so time spent waiting on a kept alive connection is not counted
+        self.started = time.perf_counter()
+        return super().parse_request()
+
+    def send_response_only(self, code, message=None):
+        self.status = int(code)
+        super().send_response_only(code, message)
 
 class HTTPSServer(http.server.HTTPServer):
+    '''An HTTP server that serves connections over TLS. Every connection shares one `ssl.SSLContext`, so clients that
+    reconnect can resume their session with an abbreviated handshake. Handshakes are done by the thread that handles
+    the request instead of the thread that accepts connections.
+    '''
     allow_reuse_address = 1
 
-    def __init__(self, *args, **kwargs):
-        keyfile = kwargs['keyfile']
-        certfile = kwargs['certfile']
-        del kwargs['keyfile']
-        del kwargs['certfile']
-        super().__init__(*args, **kwargs)
-        self.socket = ssl.wrap_socket(self.socket, server_side=True, keyfile=keyfile, certfile=certfile, ssl_version=ssl.PROTOCOL_TLS)
+    def __init__(self, server_address, RequestHandlerClass, bind_and_activate=True, keyfile=None, certfile=None, context=None):
+        self.context = context or create_context(keyfile, certfile)
+        self.handshakes = HandshakeCounters()
+        self.metrics = ServerMetrics()
+        super().__init__(server_address, RequestHandlerClass, bind_and_activate)
+
+    def finish_request(self, request, client_address):
+        self.metrics.connected()
+        try:
+            start = time.perf_counter()
+            try:
+                request.do_handshake()
+            except (OSError, ssl.SSLError):
+                return self.handshakes.failed()
+            self.handshakes.record(request, start)
+            super().finish_request(request, client_address)
+        finally:
+            self.metrics.disconnected()
+
+    def get_request(self):
+        request, client_address = self.socket.accept()
+        return self.context.wrap_socket(request, server_side=True, do_handshake_on_connect=False), client_address
 
 class ThreadingHTTPSServer(socketserver.ThreadingMixIn, HTTPSServer):
     daemon_threads = True
 
-def generate_key():
-    '''Creates an RSA key pair.
+class AsyncHTTPSServer:
+    '''An HTTPS server that serves connections from an asyncio event loop instead of a thread per connection.
+    Connections are kept alive between requests and the number of connections served at once is bounded. Request
+    handlers run on a thread pool, and the files they send are read in slices on the pool as the TLS transport drains, so
+    a response does not hold a whole file in memory. The class follows the `socketserver.TCPServer` interface.
+    '''
+    address_family = socket.AF_INET
+    allow_reuse_address = True
+    request_queue_size = 128
+    # The size of each slice of a file that is read and written to a connection
+    write_size = 256 * 1024
+    # Requests with larger bodies are rejected before their bodies are read
+    max_body_size = 1024 * 1024
+
+    def __init__(self, server_address, RequestHandlerClass, bind_and_activate=True, keyfile=None, certfile=None, context=None, max_connections=256, max_workers=32, timeout=15):
+        self.server_address = server_address
+        self.RequestHandlerClass = _async_handler(RequestHandlerClass)
+        self.context = context or create_context(keyfile, certfile)
+        self.handshakes = HandshakeCounters()
+        self.metrics = ServerMetrics()
+        self.max_connections = max_connections
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.loop = None
+        self.socket = socket.socket(self.address_family, socket.SOCK_STREAM)
+        if bind_and_activate:
+            try:
+                self.server_bind()
+                self.server_activate()
+            except:
+                self.server_close()
+                raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.server_close()
+
+    async def __connection(self, reader, writer):
+        async with self.semaphore:
+            self.handshakes.record(writer.get_extra_info('ssl_object'))
+            self.metrics.connected()
+            try:
+                while True:
+                    try:
+                        head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), self.timeout)
+                    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError):
+                        break
+                    length = re.search(rb'(?im)^content-length:[ \t]*([0-9]+)', head)
+                    length = int(length.group(1)) if length else 0
+                    if length > self.max_body_size:
+                        status = http.HTTPStatus.REQUEST_ENTITY_TOO_LARGE
+                        writer.write('HTTP/1.1 {} {}\r\nContent-Length: 0\r\nConnection: close\r\n\r\n'.format(status.value, status.phrase).encode('latin-1'))
+                        await asyncio.wait_for(writer.drain(), self.timeout)
+                        break
+                    body = await asyncio.wait_for(reader.readexactly(length), self.timeout)
+                    response = await self.loop.run_in_executor(self.executor, self.__handle, head + body, writer.get_extra_info('peername'))
+                    try:
+                        for chunk in response.chunks:
+                            if isinstance(chunk, _FileSlice):
+                                while True:
+                                    data = await self.loop.run_in_executor(self.executor, chunk.read, self.write_size)
+                                    if not data:
+                                        break
+                                    self.metrics.sent(len(data))
+                                    writer.write(data)
+                                    await asyncio.wait_for(writer.drain(), self.timeout)
+                                # A file that was truncated while it was sent is shorter than its Content-Length
+                                response.close = response.close or chunk.remaining > 0
+                            else:
+                                self.metrics.sent(len(chunk))
+                                writer.write(chunk)
+                        await asyncio.wait_for(writer.drain(), self.timeout)
+                        if response.timing:
+                            path, started, status = response.timing
+                            self.metrics.request(path, time.perf_counter() - started, status)
+                    finally:
+                        for chunk in response.chunks:
+                            if isinstance(chunk, _FileSlice):
+                                chunk.close()
+                    if response.close:
+                        break
+            except (ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError, ssl.SSLError):
+                pass
+            finally:
+                self.metrics.disconnected()
+                writer.close()
+
+    def __handle(self, request, client_address):
+        return self.RequestHandlerClass(request, client_address, self).wfile
+
+    async def __serve(self):
+        self.executor = concurrent.futures.ThreadPoolExecutor(self.max_workers)
+        self.semaphore = asyncio.Semaphore(self.max_connections)
+        self.stopped = asyncio.Event()
+        server = await asyncio.start_server(self.__connection, sock=self.socket, ssl=self.context, ssl_handshake_timeout=self.timeout, limit=64 * 1024)
+        try:
+            await self.stopped.wait()
+        finally:
+            server.close()
+            self.executor.shutdown(wait=False)
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def serve_forever(self):
+        self.loop = asyncio.new_event_loop()
+        try:
+            self.loop.run_until_complete(self.__serve())
+        finally:
+            self.loop.close()
+
+    def server_activate(self):
+        self.socket.listen(self.request_queue_size)
+
+    def server_bind(self):
+        if self.allow_reuse_address:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(self.server_address)
+        self.server_address = self.socket.getsockname()
+        host, port = self.server_address[:2]
+        self.server_name = socket.getfqdn(host)
+        self.server_port = port
+
+    def server_close(self):
+        self.socket.close()
+
+    def shutdown(self):
+        if self.loop:
+            self.loop.call_soon_threadsafe(self.stopped.set)
+
+class ResponseCache:
+    '''A thread safe LRU cache of file contents that is bounded by the total size of the cached responses.'''
+    def __init__(self, size=64 * 1024 * 1024, file_size=1024 * 1024):
+        self.size = size
+        self.file_size = file_size
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.used = 0
+        self.counts = collections.Counter()
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.used = 0
+
+    def get(self, path, stat):
+        '''Get the cached contents of a file if it has not changed since it was cached.
 
-    :return: Path to an RSA private key. The public key will have a .pub extension
-    :rtype: str
+        :param path: The path to the file
+        :type path: str
+        :param stat: The current status of the file
+        :type stat: class:`os.stat_result`
+        :rtype: class:`_CacheEntry` or None
+        '''
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry and (entry.mtime, entry.length) == (stat.st_mtime_ns, stat.st_size):
+                self.entries.move_to_end(path)
+                self.counts['hits'] += 1
+                return entry
+            self.counts['misses'] += 1
+
+    def put(self, path, entry):
+        with self.lock:
+            if path in self.entries:
+                self.used -= self.entries.pop(path).size
+            self.entries[path] = entry
+            self.used += entry.size
+            while self.used > self.size:
+                self.used -= self.entries.popitem(last=False)[1].size
+
+class CachingHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
+    '''Serve files like `http.server.SimpleHTTPRequestHandler`, but keep small files and their gzip encoding in a shared
+    `ResponseCache`. Files have strong ETags, so clients that send a matching If-None-Match get a 304 response, and
+    single byte ranges can be requested. Files that are too large to cache are read in chunks as they are sent.
     '''
-    key = OpenSSL.crypto.PKey()
-    key.generate_key(OpenSSL.crypto.TYPE_RSA, 4096)
-    keyFile = tempfile.mktemp()
-    with open(keyFile, 'wb') as file:
-        file.write(OpenSSL.crypto.dump_privatekey(OpenSSL.crypto.FILETYPE_PEM, key))
-    with open('{}.pub'.format(keyFile), 'wb') as file:
-        file.write(OpenSSL.crypto.dump_publickey(OpenSSL.crypto.FILETYPE_PEM, key))
-    return keyFile
-
-def generate_cert(keyfile, expiration=12*365*24*60*60):
-    '''Creates a key and self-signed cert.
-
-    :param keyfile: Path to an RSA private key
+    cache = ResponseCache()
+    # Types that are worth compressing in addition to text/*
+    compressible = re.compile(r'^(text/|application/(([a-z.+-]+\+)?(json|xml)|javascript|x-sh|x-tar|wasm)$|image/svg\+xml$)')
+    # Files smaller than this are not compressed
+    compress_size = 256
+
+    def do_GET(self):
+        body = self.send_head()
+        if isinstance(body, memoryview):
+            self.wfile.write(body)
+        elif body:
+            try:
+                self.copyfile(body, self.wfile)
+            finally:
+                body.close()
+            # A file that was truncated while it was sent is shorter than its Content-Length, so the connection can not be reused
+            if getattr(body, 'remaining', 0):
+                self.close_connection = True
+
+    def do_HEAD(self):
+        body = self.send_head()
+        if body and not isinstance(body, memoryview):
+            body.close()
+
+    def accepts_gzip(self):
+        for coding in self.headers.get('Accept-Encoding', '').split(','):
+            coding, _, parameters = coding.strip().lower().partition(';')
+            if coding in ['gzip', '*']:
+                return not re.match(r'^\s*q\s*=\s*0(\.0*)?\s*$', parameters)
+        return False
+
+    def load(self, path):
+        '''Get the contents of a file from the cache, or read it and cache it if it is small enough.
+        Files that are too large to cache are not read, and their entry has no data.
+        '''
+        stat = os.stat(path)
+        entry = self.cache.get(path, stat)
+        if entry:
+            return entry
+        if stat.st_size > self.cache.file_size:
+            return _CacheEntry(None, stat, self.guess_type(path))
+        with open(path, 'rb') as file:
+            stat = os.fstat(file.fileno())
+            data = file.read()
+        entry = _CacheEntry(data, stat, self.guess_type(path))
+        if len(data) >= self.compress_size and self.compressible.match(entry.type):
+            encoded = gzip.compress(data, 6)
+            entry.gzip = encoded if len(encoded) < len(data) else None
+        self.cache.put(path, entry)
+        return entry
+
+    def not_modified(self, entry, etag):
+        if 'If-None-Match' in self.headers:
+            tags = [_.strip() for _ in self.headers['If-None-Match'].split(',')]
+            # If-None-Match uses the weak comparison
+            return '*' in tags or etag in (tag[2:] if tag.startswith('W/') else tag for tag in tags)
+        if 'If-Modified-Since' in self.headers:
+            try:
+                since = email.utils.parsedate_to_datetime(self.headers['If-Modified-Since'])
+            except (TypeError, IndexError, OverflowError, ValueError):
+                return False
+            return since.tzinfo is not None and entry.mtime // 10**9 <= since.timestamp()
+        return False
+
+    def range(self, entry):
+        '''Get the byte range to send from the Range header.
+
+        :return: The start and end (exclusive) of the range, None for the whole file, or False if it can not be satisfied
+        :rtype: tuple
+        '''
+        match = re.match(r'^bytes=(\d*)-(\d*)$', self.headers.get('Range', '').replace(' ', ''))
+        # Multiple ranges are served as the whole file, and If-Range asks for the whole file if it has changed
+        if not match or match.groups() == ('', '') or self.headers.get('If-Range', entry.etag) not in [entry.etag, self.date_time_string(entry.mtime / 10**9)]:
+            return None
+        first, last = match.groups()
+        if not first:
+            start, end = max(0, entry.length - int(last)), entry.length
+        else:
+            start, end = int(first), min(entry.length, int(last) + 1) if last else entry.length
+        return (start, end) if start < end else False
+
+    def send_head(self):
+        path = self.translate_path(self.path)
+        if os.path.isdir(path):
+            # Redirects and directory listings are not cached
+            index = next((os.path.join(path, _) for _ in ['index.html', 'index.htm'] if os.path.isfile(os.path.join(path, _))), None)
+            if not index or not urllib.parse.urlsplit(self.path).path.endswith('/'):
+                return super().send_head()
+            path = index
+        if path.endswith('/'):
+            return self.send_error(http.HTTPStatus.NOT_FOUND, 'File not found')
+        try:
+            entry = self.load(path)
+        except OSError:
+            return self.send_error(http.HTTPStatus.NOT_FOUND, 'File not found')
+        encoded = entry.gzip is not None and 'Range' not in self.headers and self.accepts_gzip()
+        etag = entry.etag[:-1] + '-gzip"' if encoded else entry.etag
+        if self.not_modified(entry, etag):
+            self.send_response(http.HTTPStatus.NOT_MODIFIED)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return None
+        byterange = None if encoded else self.range(entry)
+        if byterange is False:
+            self.send_response(http.HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+            self.send_header('Content-Range', 'bytes */{}'.format(entry.length))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return None
+        start, end = byterange or (0, len(entry.gzip) if encoded else entry.length)
+        if entry.data is None:
+            # Files that are not cached are read as they are sent, so a file that changes while it is sent can only end
+            # the response early
+            try:
+                body = _FileSlice(open(path, 'rb'), start, end - start)
+            except OSError:
+                return self.send_error(http.HTTPStatus.NOT_FOUND, 'File not found')
+        else:
+            body = memoryview(entry.gzip if encoded else entry.data)[start:end]
+        if byterange:
+            self.send_response(http.HTTPStatus.PARTIAL_CONTENT)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end - 1, entry.length))
+        else:
+            self.send_response(http.HTTPStatus.OK)
+        self.send_header('Content-type', entry.type)
+        self.send_header('Content-Length', str(end - start))
+        self.send_header('Last-Modified', self.date_time_string(entry.mtime / 10**9))
+        self.send_header('ETag', etag)
+        self.send_header('Accept-Ranges', 'bytes')
+        if encoded:
+            self.send_header('Content-Encoding', 'gzip')
+        if entry.gzip is not None:
+            self.send_header('Vary', 'Accept-Encoding')
+        self.end_headers()
+        return body
+
+class _CountingWriter:
+    def __init__(self, file, metrics):
+        self.file = file
+        self.metrics = metrics
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+    def write(self, data):
+        self.metrics.sent(len(data))
+        return self.file.write(data)
+
+class _FileSlice:
+    '''A range of an open file that is read in chunks, which ends early if the file is truncated.'''
+    def __init__(self, file, start, length):
+        self.file = file
+        self.file.seek(start)
+        self.remaining = length
+
+    def close(self):
+        self.file.close()
+
+    def detach(self):
+        '''Move the rest of the slice to a new slice of a duplicate descriptor, which stays open when this slice is closed.'''
+        detached = _FileSlice(open(os.dup(self.file.fileno()), 'rb'), self.file.tell(), self.remaining)
+        self.remaining = 0
+        return detached
+
+    def read(self, size=-1):
+        data = self.file.read(self.remaining if size is None or size < 0 else min(size, self.remaining))
+        self.remaining -= len(data)
+        return data
+
+class _CacheEntry:
+    __slots__ = ['data', 'etag', 'gzip', 'length', 'mtime', 'type']
+
+    def __init__(self, data, stat, type):
+        self.data = data
+        # The modification time and size change whenever the contents do, so they make a strong validator
+        self.etag = '"{:x}-{:x}"'.format(stat.st_mtime_ns, stat.st_size)
+        self.gzip = None
+        self.length = stat.st_size
+        self.mtime = stat.st_mtime_ns
+        self.type = type
+
+    @property
+    def size(self):
+        return len(self.data) + len(self.gzip or b'')
+
+class _AsyncRequestHandler:
+    '''Run a request handler on a request that has already been read and capture its response for the event loop.'''
+    protocol_version = 'HTTP/1.1'
+    # CGI scripts are run with subprocess instead of fork so that their output can be captured
+    have_fork = False
+
+    def setup(self):
+        self.connection = None
+        self.rfile = _RequestFile(self.request)
+        self.wfile = _Response()
+
+    def handle(self):
+        self.close_connection = True
+        self.handle_one_request()
+        # Responses without a length, such as CGI output, can only end by closing the connection
+        self.wfile.close = self.close_connection or not self.wfile.length
+
+    def finish(self):
+        self.rfile.close()
+
+    def copyfile(self, source, outputfile):
+        # Files are read by the event loop as they are sent instead of being read into the response
+        if outputfile is self.wfile and not isinstance(source, _FileSlice) and hasattr(source, 'fileno'):
+            try:
+                source = _FileSlice(source, source.tell(), max(0, os.fstat(source.fileno()).st_size - source.tell()))
+            except OSError: # In memory files have no descriptor
+                pass
+        if outputfile is self.wfile and isinstance(source, _FileSlice):
+            outputfile.chunks.append(source.detach())
+            return
+        super().copyfile(source, outputfile)
+
+    def send_response_only(self, code, message=None):
+        # Responses without a body do not need a length to keep the connection open
+        self.wfile.length = code in [http.HTTPStatus.NO_CONTENT, http.HTTPStatus.NOT_MODIFIED]
+        super().send_response_only(code, message)
+
+    def send_header(self, keyword, value):
+        if keyword.lower() == 'content-length':
+            self.wfile.length = True
+        super().send_header(keyword, value)
+
+class _RequestFile(io.BytesIO):
+    @property
+    def _sock(self):
+        # CGI handlers drain the request socket, so give them a socket that is already at its end
+        if not hasattr(self, '_drained'):
+            self._drained, peer = socket.socketpair()
+            peer.close()
+        return self._drained
+
+    def close(self):
+        if hasattr(self, '_drained'):
+            self._drained.close()
+        super().close()
+
+class _Response:
+    def __init__(self):
+        self.chunks = list()
+        self.close = True
+        self.length = False
+        # The path, start time and status of a request that is timed by `MetricsMixIn`
+        self.timing = None
+
+    def flush(self):
+        pass
+
+    def write(self, data):
+        # Views of immutable data, such as cached files, do not need to be copied
+        self.chunks.append(data if isinstance(data, memoryview) and data.readonly else bytes(data))
+        return len(data)
+
+def _async_handler(HandlerClass):
+    return _mix_in(_AsyncRequestHandler, HandlerClass, 'Async')
+
+def _mix_in(MixIn, HandlerClass, prefix):
+    keywords = dict()
+    if isinstance(HandlerClass, functools.partial):
+        keywords, HandlerClass = HandlerClass.keywords, HandlerClass.func
+    handler = type(prefix + HandlerClass.__name__, (MixIn, HandlerClass), dict())
+    return functools.partial(handler, **keywords) if keywords else handler
+
+def create_context(keyfile, certfile, alpn=('http/1.1',), ciphers=None, minimum_version=None, tickets=2):
+    '''Create a server `ssl.SSLContext` to be shared by every connection. Session tickets are enabled so that clients
+    can resume their sessions, and the start of each handshake is recorded for `HandshakeCounters`.
+
+    :param keyfile: Path to the private key
     :type keyfile: str
-    :param expiration: how long the cert is valid in seconds, defaults to one year
+    :param certfile: Path to the PEM formatted cert chain
+    :type certfile: str
+    :param alpn: Protocols to offer with ALPN, defaults to http/1.1
+    :type alpn: list, optional
+    :param ciphers: An OpenSSL cipher list for TLS 1.2 and older, defaults to the ssl module defaults
+    :type ciphers: str, optional
+    :param minimum_version: The minimum TLS version, such as TLSv1_2 or TLSv1_3
+    :type minimum_version: str or class:`ssl.TLSVersion`, optional
+    :param tickets: The number of TLS 1.3 session tickets to send after a full handshake
+    :type tickets: int, optional
+    :return: The context
+    :rtype: class:`ssl.SSLContext`
+    '''
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(certfile, keyfile)
+    context.options &= ~ssl.OP_NO_TICKET
+    context.options |= ssl.OP_CIPHER_SERVER_PREFERENCE | ssl.OP_NO_COMPRESSION
+    if hasattr(context, 'num_tickets'):
+        context.num_tickets = tickets
+    if alpn:
+        context.set_alpn_protocols(list(alpn))
+    if ciphers:
+        context.set_ciphers(ciphers)
+    if minimum_version:
+        context.minimum_version = ssl.TLSVersion[minimum_version] if isinstance(minimum_version, str) else minimum_version
+    # The callback runs when the client hello is received, even if the client does not send a server name
+    context.sni_callback = lambda ssl_object, server_name, context: setattr(ssl_object, 'handshake_started', time.perf_counter())
+    return context
+
+def provision_credentials(key_type='ec', directory=None, expiration=365*24*60*60, renewal=24*60*60):
+    '''Gets a private key and self-signed cert from a per-user cache, creating them if they do not exist or expire soon.
+    Reusing the credentials makes startup fast and lets clients pin the cert.
+
+    :param key_type: The type of key to use, either ec (P-256), ed25519, or rsa
+    :type key_type: str, optional
+    :param directory: The cache directory, defaults to $XDG_STATE_HOME/scripts/sserv or ~/.local/state/scripts/sserv
+    :type directory: str, optional
+    :param expiration: How long a new cert is valid in seconds, defaults to one year
     :type expiration: int, optional
-    :return: PEM formatted X509 cert
-    :rtype: class:`simpleble.SimpleBleClient`
+    :param renewal: How long before a cert expires that it is replaced in seconds, defaults to one day
+    :type renewal: int, optional
+    :return: Paths to the private key and the PEM formatted X509 cert
+    :rtype: tuple
     '''
-    # Create a cert
-    cert = OpenSSL.crypto.X509()
-    cert.gmtime_adj_notBefore(0)
-    cert.gmtime_adj_notAfter(expiration)
-    # Self-sign and write the cert to a temporary file
-    with open('{}.pub'.format(keyfile), 'rb') as file:
-        cert.set_pubkey(OpenSSL.crypto.load_publickey(OpenSSL.crypto.FILETYPE_PEM, file.read()))
-    with open(keyfile, 'rb') as file:
-        cert.sign(OpenSSL.crypto.load_privatekey(OpenSSL.crypto.FILETYPE_PEM, file.read()), 'sha512')
-    certFile = tempfile.mktemp()
-    with open(certFile, 'wb') as file:
-        file.write(OpenSSL.crypto.dump_certificate(OpenSSL.crypto.FILETYPE_PEM, cert))
-    return certFile
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec, ed25519, rsa
+
+    directory = directory or os.path.join(os.environ.get('XDG_STATE_HOME') or os.path.join(os.path.expanduser('~'), '.local', 'state'), 'scripts', 'sserv')
+    keyfile, certfile = (os.path.join(directory, '{}.{}'.format(key_type, extension)) for extension in ['key', 'crt'])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    if os.path.isfile(keyfile) and os.path.isfile(certfile):
+        with open(certfile, 'rb') as file:
+            cert = x509.load_pem_x509_certificate(file.read())
+        notAfter = cert.not_valid_after_utc if hasattr(cert, 'not_valid_after_utc') else cert.not_valid_after.replace(tzinfo=datetime.timezone.utc)
+        if notAfter - now > datetime.timedelta(seconds=renewal):
+            return keyfile, certfile
+    generators = {
+        'ec': lambda: ec.generate_private_key(ec.SECP256R1()),
+        'ed25519': ed25519.Ed25519PrivateKey.generate,
+        'rsa': lambda: rsa.generate_private_key(public_exponent=65537, key_size=4096)
+    }
+    key = generators[key_type]()
+    hostname = socket.gethostname()
+    name = x509.Name([x509.NameAttribute(x509.oid.NameOID.COMMON_NAME, hostname)])
+    cert = x509.CertificateBuilder().subject_name(name).issuer_name(name).public_key(key.public_key()) \
+        .serial_number(x509.random_serial_number()).not_valid_before(now).not_valid_after(now + datetime.timedelta(seconds=expiration)) \
+        .add_extension(x509.SubjectAlternativeName([x509.DNSName(hostname), x509.DNSName('localhost')]), critical=False) \
+        .sign(key, None if key_type == 'ed25519' else hashes.SHA256())
+    # Only the current user may read the private key
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    with open(os.open(keyfile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'wb') as file:
+        file.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()))
+    with open(certfile, 'wb') as file:
+        file.write(cert.public_bytes(serialization.Encoding.PEM))
+    return keyfile, certfile
 
 # modified from: cpython/blob/3.10/Lib/http/server.py
 def test(HandlerClass=http.server.BaseHTTPRequestHandler, ServerClass=ThreadingHTTPSServer, protocol='HTTP/1.0', port=8443, bind=None):
@@ -88,7 +762,7 @@ def test(HandlerClass=http.server.BaseHTTPRequestHandler, ServerClass=ThreadingH
     infos = socket.getaddrinfo(bind, port, type=socket.SOCK_STREAM, flags=socket.AI_PASSIVE)
     ServerClass.address_family, type, proto, canonname, sockaddr = next(iter(infos))
     # Start the server
-    HandlerClass.protocol_version = protocol
+    (HandlerClass.func if isinstance(HandlerClass, functools.partial) else HandlerClass).protocol_version = protocol
     with ServerClass(sockaddr, HandlerClass) as httpd:
         host, port = httpd.socket.getsockname()[:2]
         url_host = f'[{host}]' if ':' in host else host
@@ -96,6 +770,8 @@ def test(HandlerClass=http.server.BaseHTTPRequestHandler, ServerClass=ThreadingH
         try:
             httpd.serve_forever()
         except KeyboardInterrupt:
+            if hasattr(httpd, 'handshakes'):
+                print('\nTLS handshakes: {}'.format(httpd.handshakes), end='')
             print('\nKeyboard interrupt received, exiting.')
             sys.exit(0)
 
@@ -108,24 +784,38 @@ def main():
     import os
 
     parser = argparse.ArgumentParser(description='Start an HTTPs server.')
+    parser.add_argument('--alpn', action='append', help='Protocol to offer with ALPN, may be given more than once [default: http/1.1]')
+    parser.add_argument('--cache-size', default=64, type=int, help='MiB of small files to keep in memory, 0 to read every file from disk [default: 64]')
     parser.add_argument('--cgi', action='store_true', help='Run as CGI Server')
+    parser.add_argument('--ciphers', help='OpenSSL cipher list for TLS 1.2 and older [default: ssl module defaults]')
+    parser.add_argument('--metrics', action='store_true', help='Serve metrics as JSON from {}'.format(MetricsMixIn.metrics_path))
+    parser.add_argument('--min-version', choices=['TLSv1', 'TLSv1_1', 'TLSv1_2', 'TLSv1_3'], help='Minimum TLS version [default: ssl module defaults]')
+    parser.add_argument('--tickets', default=2, type=int, help='TLS 1.3 session tickets to send after each full handshake [default: 2]')
     parser.add_argument('-b', '--bind', metavar='ADDRESS', help='Specify alternate bind address [default: all interfaces]')
+    parser.add_argument('-e', '--engine', choices=['async', 'threading'], default='threading', help='Serve connections from an event loop or a thread per connection [default: threading]')
     parser.add_argument('-d', '--directory', default=os.getcwd(), help='Specify alternative directory [default:current directory]')
+    parser.add_argument('-P', '--protocol', choices=['HTTP/1.0', 'HTTP/1.1'], help='HTTP version of the threading engine, HTTP/1.1 keeps connections alive [default: HTTP/1.0]')
     parser.add_argument('-k', '--key', help='Private key [default:auto generated]')
     parser.add_argument('-c', '--cert', help='Specify cert [default:self signed]')
+    parser.add_argument('-t', '--key-type', choices=['ec', 'ed25519', 'rsa'], default='ec', help='Type of key to generate if no key is specified [default: ec]')
     parser.add_argument('port', action='store', default=8443, type=int, nargs='?', help='Specify alternate port [default: 8443]')
     args = parser.parse_args()
     if args.cgi:
         handler_class = http.server.CGIHTTPRequestHandler
-    else:
+    elif not args.cache_size:
         handler_class = functools.partial(http.server.SimpleHTTPRequestHandler, directory=args.directory)
+    else:
+        CachingHTTPRequestHandler.cache = ResponseCache(args.cache_size * 1024 * 1024)
+        handler_class = functools.partial(CachingHTTPRequestHandler, directory=args.directory)
+    if args.metrics:
+        handler_class = _mix_in(MetricsMixIn, handler_class, 'Metrics')
     keyfile, certfile = (args.key, args.cert)
+    context = None
     
     # Ensure dual-stack is not disabled; ref #38907
-    class DualStackServer(ThreadingHTTPSServer):
+    class DualStackServer(AsyncHTTPSServer if args.engine == 'async' else ThreadingHTTPSServer):
         def __init__(self, *args, **kwargs):
-            kwargs['keyfile'] = keyfile
-            kwargs['certfile'] = certfile
+            kwargs['context'] = context
             super().__init__(*args, **kwargs)
 
         def server_bind(self):
@@ -134,20 +824,15 @@ def main():
                 self.socket.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0)
             return super().server_bind()
 
-    try:
-        if not (args.key and args.cert):
-            keyfile = generate_key()
-            certfile = generate_cert(keyfile)
-            for path in [keyfile, '{}.pub'.format(keyfile), certfile]:
-                with open(path) as file:
-                    print(file.read())
-
-            test(HandlerClass=handler_class, ServerClass=DualStackServer, port=args.port, bind=args.bind)
-    finally:
-        if not (args.key and args.cert):
-            for path in [keyfile, '{}.pub'.format(keyfile), certfile]:
-                if os.path.isfile(path):
-                    os.unlink(path)
+    if not (args.key and args.cert):
+        keyfile, certfile = provision_credentials(args.key_type)
+        with open(certfile) as file:
+            cert = file.read()
+        print(cert)
+        fingerprint = hashlib.sha256(ssl.PEM_cert_to_DER_cert(cert)).hexdigest()
+        print('Using the cached key {} and cert with SHA-256 fingerprint {}'.format(keyfile, ':'.join(fingerprint[_:_ + 2] for _ in range(0, len(fingerprint), 2)).upper()))
+    context = create_context(keyfile, certfile, alpn=args.alpn or ['http/1.1'], ciphers=args.ciphers, minimum_version=args.min_version, tickets=args.tickets)
+    test(HandlerClass=handler_class, ServerClass=DualStackServer, protocol='HTTP/1.1' if args.engine == 'async' else args.protocol or 'HTTP/1.0', port=args.port, bind=args.bind)
 
 if __name__ == '__main__':
     try:
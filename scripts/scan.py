@@ -4,17 +4,24 @@
 '''File, directory, and archive scanning.'''
 
 __all__ = [
-    'archive', 'directory', 'file', 'main', 'open_uncompressed'
+    'Index', 'Writer', 'archive', 'directory', 'file', 'main', 'open_uncompressed'
 ]
 
+import bisect
 import bz2, gzip, lzma
-import mimetypes
+import collections
+import csv
+import functools
+import hashlib
+import io
+import json
+import mmap
+import multiprocessing
 import os
 import re
-from rich.console import Console
-from rich.table import Column, Table
+import sqlite3
+import sys
 import tarfile, zipfile
-import tempfile
 
 # Do not include a regex for URLs because it causes too many duplicates with email, domain_name, ipv4_address, and ipv6_address
 identifiers = {
@@ -35,63 +42,612 @@ identifiers = {
     'words': r'_^' # Match nothing by default
 }
 
-def archive(path, regexes, password=None, verbose=False):
-    filetype = mimetypes.guess_type(path, strict=False)
-    if filetype[0] and filetype[0] in ['application/x-tar', 'application/zip']:
-        tempdir = tempfile.TemporaryDirectory()
+# Prefilters are cheap searches for data that every match of an identifier must include
+# Identifiers are only searched for in the blocks of BLOCK_SIZE bytes (or characters) of a window that pass their prefilter
+prefilters = {
+    'email': r'@',
+    'domain_name': r'\.[a-z]{2}',
+    'imei': r'[0-9]{15}',
+    'ipv4_address': r'[0-9]\.[0-9]',
+    'ipv6_address': r':',
+    'mac_address': r'[0-9A-Fa-f]{2}[:-][0-9A-Fa-f]{2}',
+    'us_phone_number': r'[0-9]{4}'
+}
+
+# The number of bytes or characters each prefilter removed from a scan, and the total number scanned under None
+statistics = collections.Counter()
+
+# Files are identified by the magic bytes at the start of their content instead of by their names
+# Each signature is the offset of the magic bytes, the magic bytes, and the file's type and compression like `mimetypes`
+signatures = [
+    (0, b'\x1f\x8b', (None, 'gzip')),
+    (0, b'BZh', (None, 'bzip2')),
+    (0, b'\xfd7zXZ\x00', (None, 'xz')),
+    (0, b'PK\x03\x04', ('application/zip', None)),
+    (0, b'PK\x05\x06', ('application/zip', None)),
+    (257, b'ustar', ('application/x-tar', None)),
+    (0, b'\x7fELF', ('application/x-executable', None)),
+    (0, b'MZ', ('application/x-msdownload', None))
+]
+archives = ['application/x-tar', 'application/zip']
+compressions = {'bzip2': bz2.open, 'gzip': gzip.open, 'xz': lzma.open}
+# Executables are not decoded as text, so they are only scanned in binary mode
+executables = ['application/x-executable', 'application/x-msdownload']
+
+# Files are scanned in windows of CHUNK_SIZE bytes (or characters in text mode) that overlap by OVERLAP
+# Matches that start in the overlap are deferred to the next window, so matches longer than OVERLAP may be truncated
+CHUNK_SIZE = 16 * 1024 * 1024
+OVERLAP = 64 * 1024
+BLOCK_SIZE = 64 * 1024
+
+# Archives nested in other archives are scanned up to ARCHIVE_DEPTH levels deep if they are at most ARCHIVE_SIZE bytes
+ARCHIVE_DEPTH = 4
+ARCHIVE_SIZE = 256 * 1024 * 1024
+
+class UnsupportedFile(Exception):
+    pass
+
+# The errors that cause a file to be skipped as unsupported
+unsupported = (EOFError, OSError, UnicodeDecodeError, lzma.LZMAError, UnsupportedFile)
+
+class Index:
+    '''A SQLite index of previous scan results so that unchanged files do not need to be scanned again.
+    Results are stored by the hash of a file's content, so files with identical content are only scanned once.
+    '''
+    # Stored instead of hits for files that could not be scanned, so they are not hashed or scanned again until they change
+    unsupported = 'unsupported'
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.changes = 0
+        # Write ahead logging lets parallel workers read the index while the reporter writes to it
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, hash TEXT)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS hits (hash TEXT, fingerprint TEXT, hits TEXT, PRIMARY KEY (hash, fingerprint))')
+        self.connection.commit()
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def __cached(path, pid):
+        return Index(path)
+
+    @staticmethod
+    def of(path):
+        '''Get an index for a database path, reusing an open index in the same process.'''
+        # SQLite connections may not be shared with forked processes
+        return Index.__cached(path, os.getpid())
+
+    @staticmethod
+    def fingerprint(regexes, verbose=False):
+        '''Identify the results of a set of regexes, which are only valid for later scans with the same regexes.'''
+        decode = lambda pattern: pattern.decode('latin-1') if type(pattern) == bytes else pattern
+        regexes = [[term, type(regex.pattern).__name__, decode(regex.pattern), regex.flags] for term, regex in sorted(regexes.items())]
+        return hashlib.sha256(json.dumps([regexes, verbose]).encode('utf-8')).hexdigest()
+
+    def commit(self):
+        self.connection.commit()
+        self.changes = 0
+
+    def lookup(self, path, fingerprint):
+        '''Find the previous results for a file. The file will only be hashed if it is new or has been modified.
+
+        :param path: A file
+        :type path: str
+        :param fingerprint: The fingerprint of the regexes the file will be scanned with
+        :type fingerprint: str
+        :return: The file's record, its previous hits, `Index.unsupported` if it could not be scanned, or None if it has not
+            been scanned, and if the record is new
+        :rtype: tuple
+        '''
+        stat = os.stat(path)
+        row = self.connection.execute('SELECT hash FROM files WHERE path = ? AND size = ? AND mtime = ?', (path, stat.st_size, stat.st_mtime_ns)).fetchone()
+        if row:
+            digest = row[0]
+        else:
+            digest = hashlib.blake2b()
+            with open(path, 'rb') as file:
+                for chunk in iter(lambda: file.read(CHUNK_SIZE), b''):
+                    digest.update(chunk)
+            digest = digest.hexdigest()
+        hits = self.connection.execute('SELECT hits FROM hits WHERE hash = ? AND fingerprint = ?', (digest, fingerprint)).fetchone()
+        return (path, stat.st_size, stat.st_mtime_ns, digest), (json.loads(hits[0]) if hits else None), not row
+
+    def store(self, record, fingerprint, hits):
+        '''Save a file's record and the hits that were found in it.'''
+        self.connection.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)', record)
+        self.connection.execute('INSERT OR REPLACE INTO hits VALUES (?, ?, ?)', (record[3], fingerprint, json.dumps(hits)))
+        self.changes += 1
+        if self.changes >= 256:
+            self.commit()
+
+class _Replay(io.RawIOBase):
+    '''Record the data read from a stream that is expensive to seek, such as a member of a compressed archive, so that
+    the stream can be sniffed and then read from its start again without seeking it.
+    '''
+    def __init__(self, stream):
+        self.stream = stream
+        self.head = bytearray()
+        self.position = 0
+        self.recording = True
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self.position < len(self.head):
+            data = self.head[self.position:self.position + len(buffer)]
+        else:
+            data = self.stream.read(len(buffer))
+            if self.recording:
+                self.head += data
+            elif self.head:
+                self.head = bytearray()
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+    def replay(self):
+        '''Stop recording and return a buffered stream that reads the recorded data again before the rest of the stream.'''
+        self.recording = False
+        self.position = 0
+        return io.BufferedReader(self)
+
+    def seekable(self):
+        return self.recording
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if not self.recording or whence != io.SEEK_SET or offset > len(self.head):
+            raise io.UnsupportedOperation('Only recorded data may be sought')
+        self.position = offset
+        return offset
+
+    def tell(self):
+        return self.position
+
+def archive(path, regexes, password=None, verbose=False, depth=ARCHIVE_DEPTH, size=ARCHIVE_SIZE, fileobj=None, report=None, stats=None, filetype=None):
+    report = report or generate_report
+    filetype = filetype or sniff(path, fileobj)
+    if filetype[0] in archives:
+        binary = type(list(regexes.values())[0].pattern) == bytes
         try:
-            with (tarfile.open(path) if filetype[0] == 'application/x-tar' else zipfile.ZipFile(path)) as archive:
-               archive.extractall(path = tempdir.name) if filetype[0] == 'application/x-tar' else archive.extractall(path = tempdir.name, pwd = password.encode('utf-8'))
-            directory(tempdir.name, regexes, recursive=True, verbose=verbose)
+            for name, member, length in members(path, password, fileobj, filetype):
+                child = path + os.path.sep + name
+                # Members are sniffed once from a replayed header because seeking back in a member of a compressed archive
+                # decompresses the archive again from its start
+                recorder = _Replay(member)
+                membertype = sniff(child, recorder)
+                stream = recorder.replay()
+                # Nested archives are buffered in memory because zip files and tar member lookups require seeking
+                if depth > 0 and length <= size and membertype[0] in archives:
+                    archive(child, regexes, password, verbose, depth - 1, size, io.BytesIO(stream.read()), report, stats, membertype)
+                    continue
+                try:
+                    report(child, search(child, regexes, verbose, fileobj=stream, stats=stats, filetype=membertype), binary)
+                except unsupported:
+                    print('Skipping file with unsupported type: {}'.format(child), file=sys.stderr)
             return True
         except Exception as _:
-            print(_)
+            print(_, file=sys.stderr)
             return True
-        finally:
-            tempdir.cleanup()
     return False
 
-def directory(path, regexes, recursive=False, verbose=False):
-    for child in os.listdir(path):
-        child = path + os.path.sep + child
-        if os.path.isfile(child):
-            if not file(child, regexes, verbose):
-                print('Skipping file with unsupported type: {}'.format(child))
-        elif recursive and os.path.isdir(child):
-            directory(path, regexes, recursive, verbose)
+def directory(path, regexes, recursive=False, verbose=False, jobs=1, index=None, report=None, password=None, depth=ARCHIVE_DEPTH, size=ARCHIVE_SIZE):
+    report = report or generate_report
+    binary = type(list(regexes.values())[0].pattern) == bytes
+    fingerprint = Index.fingerprint(regexes, verbose) if index else None
+    scan = functools.partial(_scan, regexes=regexes, verbose=verbose, index=index, fingerprint=fingerprint, password=password, depth=depth, size=size)
+    # Workers scan files in parallel but their results are reported in the order the files were walked
+    pool = multiprocessing.Pool(jobs) if jobs > 1 else None
+    try:
+        if not pool and not index:
+            # Hits that do not need to be returned from a worker or stored are reported as they are found
+            for child in walk(path, recursive):
+                filetype = sniff(child)
+                if filetype[0] in archives:
+                    archive(child, regexes, password, verbose, depth, size, report=report, filetype=filetype)
+                elif not file(child, regexes, verbose, report=report, filetype=filetype):
+                    print('Skipping file with unsupported type: {}'.format(child), file=sys.stderr)
+            return
+        for child, results, record, stats in (pool.imap(scan, walk(path, recursive), chunksize=8) if pool else map(scan, walk(path, recursive))):
+            statistics.update(stats)
+            if results is None:
+                if record:
+                    Index.of(index).store(record, fingerprint, Index.unsupported)
+                print('Skipping file with unsupported type: {}'.format(child), file=sys.stderr)
+                continue
+            if record:
+                Index.of(index).store(record, fingerprint, results[0][1])
+            for subject, hits in results:
+                report(subject, hits, binary)
+    finally:
+        if pool:
+            pool.terminate()
+        if index:
+            Index.of(index).commit()
 
-def file(path, regexes, verbose=False):
+def file(path, regexes, verbose=False, chunk_size=CHUNK_SIZE, overlap=OVERLAP, index=None, report=None, filetype=None):
+    report = report or generate_report
     binary = type(list(regexes.values())[0].pattern) == bytes
-    with open_uncompressed(path, 'rb' if binary else 'r') as file:
-        hits = list()
-        data = file.read()
-        for term, regex in regexes.items():
-            hits = hits + [{'term': term, 'offset': hex(hit.span()[0]), 'match': str(hit[0])} for hit in re.finditer(regex, data)] if binary else \
-                [{'term': term, 'line': hit[0], 'match': hit[1]} for term, regex in regexes.items() for hit in findall(data, regex, verbose)]
-        if len(hits):
-            generate_report(path, hits, binary)
-
-def findall(string, regex, verbose=False, end='.*\n'):
-    endings=[match.end() for match in re.finditer(end, string)]
-    for match in regex.finditer(string):
-        line = next((_ for _ in range(len(endings)) if endings[_] > match.start()))
+    fingerprint = Index.fingerprint(regexes, verbose) if index else None
+    record = None
+    try:
+        record, hits, changed = Index.of(index).lookup(path, fingerprint) if index else (None, None, False)
+        if hits == Index.unsupported:
+            # The file is skipped again, and its record is only stored if it is new
+            record = record if changed else None
+            raise UnsupportedFile(path)
+        if hits is None or changed:
+            hits = search(path, regexes, verbose, chunk_size, overlap, filetype=filetype) if hits is None else hits
+            if index:
+                hits = list(hits)
+                Index.of(index).store(record, fingerprint, hits)
+                Index.of(index).commit()
+        report(path, hits, binary)
+    except unsupported:
+        if record:
+            Index.of(index).store(record, fingerprint, Index.unsupported)
+            Index.of(index).commit()
+        return False
+    return True
+
+def _prefilter(term, binary=False):
+    return _compile(prefilters[term], binary) if term in prefilters else None
+
+def _blocks(prefilter, data, start, limit, overlap=OVERLAP):
+    '''Find the blocks of a window that a prefilter passes, merged into (start, end) spans.
+    A block passes if the prefilter matches in it or in the `overlap` after it, where a match starting in it may end.
+    '''
+    spans, hit = list(), None
+    for block in range(start, limit, BLOCK_SIZE):
+        end = min(block + BLOCK_SIZE, limit)
+        # A prefilter match found for an earlier block is reused until the blocks reach it
+        if hit is None or hit.start() < block:
+            hit = prefilter.search(data, block, min(len(data), limit + overlap))
+            if hit is None:
+                break
+        if hit.start() < end + overlap:
+            if spans and spans[-1][1] == block:
+                spans[-1] = (spans[-1][0], end)
+            else:
+                spans.append((block, end))
+    return spans
+
+@functools.lru_cache(maxsize=None)
+def _compile(pattern, binary=False):
+    return re.compile(pattern.encode('utf-8') if binary else pattern)
+
+def _scan(path, regexes, verbose=False, index=None, fingerprint=None, password=None, depth=ARCHIVE_DEPTH, size=ARCHIVE_SIZE):
+    # Statistics are returned because workers do not share the module's statistics
+    stats = collections.Counter()
+    record = None
+    # Archives are not indexed, and the hits of each of their members are returned to be reported in order
+    filetype = sniff(path)
+    if filetype[0] in archives:
+        results = list()
+        archive(path, regexes, password, verbose, depth, size, report=lambda subject, hits, binary=False: results.append((subject, list(hits))), stats=stats, filetype=filetype)
+        return path, results, None, stats
+    try:
+        record, hits, changed = Index.of(index).lookup(path, fingerprint) if index else (None, None, False)
+        # Only return a record to store if the file is new, modified, or had to be scanned
+        if hits == Index.unsupported:
+            return path, None, record if changed else None, stats
+        if hits is None:
+            hits = list(search(path, regexes, verbose, stats=stats, filetype=filetype))
+        elif not changed:
+            record = None
+        return path, [(path, hits)], record, stats
+    except unsupported:
+        return path, None, record, stats
+
+def findall(string, regexes, verbose=False, end='.*\n', pos=0, endpos=None, ends=None, spans=None, overlap=OVERLAP):
+    # Index the line endings once so each match's line and context are found with a binary search
+    endings = [match.end() for match in re.finditer(end, string)]
+    for term, match in matches(regexes, string, pos, endpos, ends, spans, overlap):
+        line = bisect.bisect_right(endings, match.start())
         result = match.string[match.start():match.end()]
         if verbose:
-            result = (string[(endings[line - 1] if line else 0):match.start()] + '[r]' + result + '[not r]' + string[match.end():endings[line]]).strip()
-        yield (line + 1, result)
+            result = (string[(endings[line - 1] if line else 0):match.start()] + '[r]' + result + '[not r]' + string[match.end():(endings[line] if line < len(endings) else len(string))]).strip()
+        yield (term, line + 1, result)
 
 def generate_report(subject, hits, binary=False):
     reference = 'offset' if binary else 'line'
+    hits = sorted(hits, key=lambda item: item[reference])
+    if not len(hits):
+        return
+    # Rich is only imported when a report is printed, so formats that do not use it start faster
+    from rich.console import Console
+    from rich.table import Column, Table
     table = Table(Column(header='Offset' if binary else 'Line', justify='right'), 'Search Term', Column(header='Match', no_wrap=True), title=subject)
-    hits.sort(key=lambda item: item[reference])
     for hit in hits:
         table.add_row(str(hit[reference]), hit['term'], hit['match'])
     Console().print(table)
 
-def open_uncompressed(path, *args, **kwargs):
-    filetype =  mimetypes.guess_type(path)
-    compressions = {'bzip2': bz2.open, 'gzip': gzip.open, 'xz': lzma.open}
-    return (compressions[filetype[1]] if filetype[1] in compressions.keys() else open)(path, *args, **kwargs)
+class Writer:
+    '''Write hits as newline delimited JSON or CSV as soon as they are found.
+    Unlike `generate_report`, hits are not collected or sorted, so memory use does not grow with the number of hits.
+    '''
+    formats = ['csv', 'ndjson']
+
+    def __init__(self, format='ndjson', stream=None, buffering=1024 * 1024):
+        if format not in Writer.formats:
+            raise ValueError('Unsupported format: {}'.format(format))
+        self.format = format
+        self.stream = stream or open(sys.stdout.fileno(), 'w', buffering=buffering, encoding='utf-8', newline='', closefd=False)
+        self.writer = None
+
+    def __call__(self, subject, hits, binary=False):
+        reference = 'offset' if binary else 'line'
+        if self.format == 'ndjson':
+            for hit in hits:
+                self.stream.write(json.dumps({'file': subject, reference: hit[reference], 'term': hit['term'], 'match': hit['match']}) + '\n')
+        else:
+            for hit in hits:
+                # The header is written with the first hit so that scans without hits have no output
+                if not self.writer:
+                    self.writer = csv.writer(self.stream)
+                    self.writer.writerow(['file', reference, 'term', 'match'])
+                self.writer.writerow([subject, hit[reference], hit['term'], hit['match']])
+
+    def flush(self):
+        self.stream.flush()
+
+def generate_statistics(terms):
+    from rich.console import Console
+    from rich.markup import escape
+    from rich.table import Column, Table
+    table = Table('Search Term', Column(header='Prefilter', no_wrap=True), Column(header='Removed', justify='right'), Column(header='Percent', justify='right'), title='Prefilter Statistics')
+    for term in terms:
+        removed = statistics[term]
+        table.add_row(term, escape(prefilters.get(term, '')), str(removed), '{:.1f}%'.format(100 * removed / statistics[None]) if statistics[None] else '')
+    Console(stderr=True).print(table)
+
+def matches(regexes, string, pos=0, endpos=None, ends=None, spans=None, overlap=OVERLAP):
+    '''Yield the term and match object for each nonempty match of each regex that starts between `pos` and `endpos`.
+    Each regex is searched for with its own `finditer` pass, so the matches are grouped by term and the time a scan takes
+    grows with the number of terms. Python's re has no DFA, so one alternation of every regex is not faster: it tries
+    each alternative at each position without the literal prefix and charset checks of the separate regexes, and
+    overlapping matches of other terms would have to be searched for again.
+
+    :param ends: The end of the last match of each term, which is updated as matches are found
+    :type ends: dict, optional
+    :param spans: The ranges that the matches of a term may start in instead of `pos` to `endpos`, such as the blocks
+        that passed the term's prefilter
+    :type spans: dict, optional
+    :param overlap: The number of positions past the end of a span that its matches may extend to
+    :type overlap: int, optional
+    '''
+    ends = dict() if ends is None else ends
+    endpos = len(string) if endpos is None else endpos
+    spans = spans or dict()
+    for term, regex in regexes.items():
+        ranges = [(begin, end, min(len(string), end + overlap)) for begin, end in spans[term]] if term in spans else [(pos, endpos, len(string))]
+        for begin, end, stop in ranges:
+            for match in regex.finditer(string, max(begin, ends.get(term, 0)), stop):
+                if match.start() >= end:
+                    break
+                if match.end() > match.start():
+                    ends[term] = match.end()
+                    yield term, match
+
+def members(path, password=None, fileobj=None, filetype=None):
+    '''Generate the regular files in a tar or zip archive without extracting them.
+    Members are read in archive order, so compressed tar archives are only decompressed once.
+
+    :param path: An archive, which is only read if `fileobj` is not given
+    :type path: str
+    :param password: A password for encrypted zip files
+    :type password: str, optional
+    :param fileobj: An archive that has already been opened
+    :type fileobj: file object, optional
+    :param filetype: The archive's type and compression if it has already been sniffed
+    :type filetype: tuple, optional
+    :return: A yielded tuple of the member's name, an open file object for the member, and its uncompressed size
+    :rtype: tuple
+    '''
+    if (filetype or sniff(path, fileobj))[0] == 'application/x-tar':
+        with tarfile.open(path if fileobj is None else None, mode='r:*', fileobj=fileobj) as archive:
+            for member in archive:
+                if member.isfile():
+                    with archive.extractfile(member) as _:
+                        yield member.name, _, member.size
+    else:
+        with zipfile.ZipFile(path if fileobj is None else fileobj) as archive:
+            for member in archive.infolist():
+                if not member.is_dir():
+                    with archive.open(member, pwd=password.encode('utf-8') if password else None) as _:
+                        yield member.filename, _, member.file_size
+
+def open_uncompressed(path, *args, fileobj=None, filetype=None, **kwargs):
+    filetype = filetype or sniff(path, fileobj)
+    if fileobj is None:
+        return (compressions[filetype[1]] if filetype[1] in compressions.keys() else open)(path, *args, **kwargs)
+    # An already open binary file object only needs to be uncompressed or decoded
+    mode = args[0] if len(args) else kwargs.get('mode', 'r')
+    return compressions[filetype[1]](fileobj, mode) if filetype[1] in compressions.keys() else fileobj if 'b' in mode else io.TextIOWrapper(fileobj)
+
+def search(path, regexes, verbose=False, chunk_size=CHUNK_SIZE, overlap=OVERLAP, fileobj=None, stats=None, filetype=None):
+    '''Scan a file for matches without reading the whole file into memory.
+
+    :param path: A file to scan, which will be uncompressed if necessary
+    :type path: str
+    :param regexes: The compiled regexes to search for, keyed by term
+    :type regexes: dict
+    :param verbose: Include the line each match is found in for text scans
+    :type verbose: bool, optional
+    :param fileobj: An open binary file object to read instead of the path, such as an archive member
+    :type fileobj: file object, optional
+    :param stats: A counter to add prefilter statistics to instead of the module's `statistics`
+    :type stats: class:`collections.Counter`, optional
+    :param filetype: The file's type and compression if it has already been sniffed
+    :type filetype: tuple, optional
+    :return: A yielded hit with the term, match, and offset or line number of the match
+    :rtype: dict
+    '''
+    binary = type(list(regexes.values())[0].pattern) == bytes
+    stats = statistics if stats is None else stats
+    filetype = filetype or sniff(path, fileobj)
+    if filetype[0] in executables and not binary:
+        raise UnsupportedFile(path)
+    with open_uncompressed(path, 'rb' if binary else 'rt', fileobj=fileobj, filetype=filetype) as file:
+        ends = dict()
+        for offset, lines, data, start, limit in windows(file, chunk_size, overlap):
+            active, spans = dict(), dict()
+            for term, regex in regexes.items():
+                prefilter = _prefilter(term, binary)
+                if prefilter:
+                    spans[term] = _blocks(prefilter, data, start, limit, overlap)
+                    stats[term] += limit - start - sum(end - begin for begin, end in spans[term])
+                    if not spans[term]:
+                        continue
+                active[term] = regex
+            stats[None] += limit - start
+            if not active:
+                continue
+            local = {term: end - offset for term, end in ends.items() if term in active}
+            if binary:
+                for term, hit in matches(active, data, start, limit, local, spans, overlap):
+                    yield {'term': term, 'offset': hex(offset + hit.start()), 'match': str(hit[0])}
+            else:
+                for term, line, match in findall(data, active, verbose, pos=start, endpos=limit, ends=local, spans=spans, overlap=overlap):
+                    yield {'term': term, 'line': lines + line, 'match': match}
+            ends.update({term: offset + end for term, end in local.items()})
+
+def sniff(path, fileobj=None):
+    '''Guess the type and compression of a file from its first bytes. Compressed files are also checked for tar archives.
+
+    :param path: A file, which is only read if `fileobj` is not given
+    :type path: str
+    :param fileobj: A seekable binary file object, which will be returned to its current position
+    :type fileobj: file object, optional
+    :return: A tuple of the file's type and compression, similar to `mimetypes.guess_type`
+    :rtype: tuple
+    '''
+    def header(opener=None):
+        if fileobj is None:
+            with (opener or open)(path, 'rb') as file:
+                return file.read(512)
+        position = fileobj.tell()
+        try:
+            return (opener(fileobj, 'rb') if opener else fileobj).read(512)
+        finally:
+            fileobj.seek(position)
+    def match(data):
+        return next((filetype for offset, magic, filetype in signatures if data[offset:offset + len(magic)] == magic), (None, None))
+    try:
+        filetype = match(header())
+        if filetype[1] in compressions and match(header(compressions[filetype[1]]))[0] == 'application/x-tar':
+            return ('application/x-tar', filetype[1])
+        return filetype
+    except (EOFError, OSError, lzma.LZMAError): # Unreadable files are reported when they are opened
+        return (None, None)
+
+def walk(path, recursive=False):
+    '''Generate the files in a directory without recursion, optionally including the files of its subdirectories.
+    Symbolic links to directories are not followed.
+
+    :param path: A directory
+    :type path: str
+    :param recursive: Include the files of subdirectories
+    :type recursive: bool, optional
+    :return: A yielded file path
+    :rtype: str
+    '''
+    directories = [path]
+    while directories:
+        children = list()
+        current = directories.pop()
+        try:
+            with os.scandir(current) as entries:
+                entries = sorted(entries, key=lambda entry: entry.name)
+        except OSError:
+            print('Skipping unreadable directory: {}'.format(current), file=sys.stderr)
+            continue
+        for entry in entries:
+            if entry.is_file():
+                yield entry.path
+            elif recursive and entry.is_dir(follow_symlinks=False):
+                children.append(entry.path)
+        directories.extend(reversed(children))
+
+def windows(stream, size=CHUNK_SIZE, overlap=OVERLAP):
+    '''Read a stream in overlapping windows so that matches across chunk boundaries are not lost.
+    Uncompressed binary files are memory mapped and returned as a single window instead.
+
+    :param stream: A file object opened by `open_uncompressed`
+    :type stream: file object
+    :param size: The number of bytes or characters to read at a time
+    :type size: int, optional
+    :param overlap: The number of bytes or characters each window shares with the next
+    :type overlap: int, optional
+    :return: A yielded tuple of the window's offset in the stream, the number of newlines before the window,
+        the window's data, and the range of window positions that matches may start in to be reported
+    :rtype: tuple
+    '''
+    if isinstance(stream, io.BufferedReader) and isinstance(stream.raw, io.FileIO):
+        try:
+            data = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError): # Empty files and special files can not be mapped
+            pass
+        else:
+            with data:
+                yield (0, 0, data, 0, len(data))
+            return
+    newline = '\n' if isinstance(stream, io.TextIOBase) else None
+    offset, lines, data, start = 0, 0, stream.read(size), 0
+    while True:
+        chunk = stream.read(size)
+        if not chunk:
+            yield (offset, lines, data, start, len(data))
+            return
+        if len(data) > overlap:
+            limit = len(data) - overlap
+            yield (offset, lines, data, start, limit)
+            # Keep at least one leading character so anchors and lookbehinds see the real preceding data. Text keeps
+            # the whole line the limit is in, so the context of matches is not cut, unless the line is longer than the overlap
+            cut = limit - 1
+            if newline:
+                bound = max(0, limit - overlap)
+                cut = min(data.rfind(newline, bound, limit) + 1 or (limit - 1 if bound else 0), limit - 1)
+            lines += data.count(newline, 0, cut) if newline else 0
+            offset, data, start = offset + cut, data[cut:], limit - cut
+        data += chunk
+
+def wordlist(words):
+    '''Build a regex that matches any word in a list.
+    Literal words are merged into a trie so that the regex engine tries each common prefix once instead of trying
+    every word at every position. Words that contain regex syntax are kept as their own alternatives.
+
+    :param words: A list of words or regexes
+    :type words: list
+    :return: A regex pattern
+    :rtype: str
+    '''
+    trie, regexes = dict(), list()
+    for word in words:
+        if set(word) & set('.^$*+?{}[]\\|()'):
+            regexes.append(word)
+            continue
+        node = trie
+        for character in word:
+            node = node.setdefault(character, dict())
+        node[''] = dict()
+    def pattern(root):
+        # Nodes are built from the leaves up with a stack instead of recursion, so long words such as hashes do not
+        # exceed the recursion limit
+        patterns, stack = dict(), [(root, False)]
+        while stack:
+            node, visited = stack.pop()
+            children = [(character, child) for character, child in sorted(node.items()) if character]
+            if not visited:
+                stack.append((node, True))
+                stack.extend((child, False) for character, child in children)
+                continue
+            branches = [re.escape(character) + patterns.pop(id(child)) for character, child in children]
+            branch = '' if not branches else branches[0] if len(branches) == 1 else '(?:{})'.format('|'.join(branches))
+            # Prefer the longest word when a shorter word is a prefix of it
+            patterns[id(node)] = '(?:{})?'.format(branch) if branch and '' in node else branch
+        return patterns[id(root)]
+    return r'|'.join(([pattern(trie)] if trie else []) + regexes) or identifiers['words']
 
 def main():
     import argparse
@@ -99,11 +655,17 @@ def main():
 
     parser = argparse.ArgumentParser(description='Scan for terms or identifiers in a file, directory, or archive.')
     parser.add_argument('-a', '--all', action='store_true', help='Search for all identifiers')
+    parser.add_argument('--archive-depth', metavar='DEPTH', default=ARCHIVE_DEPTH, type=int, help='How many levels of nested archives to scan [default: {}]'.format(ARCHIVE_DEPTH))
+    parser.add_argument('--archive-size', metavar='MIB', default=ARCHIVE_SIZE // 1024 // 1024, type=int, help='The largest nested archive to scan in MiB [default: {}]'.format(ARCHIVE_SIZE // 1024 // 1024))
     parser.add_argument('-b', '--binary', action='store_true', help='Treat all files as binaries')
+    parser.add_argument('-f', '--format', choices=['table'] + Writer.formats, default='table', help='Output format [default: table]')
     parser.add_argument('-i', '--identifiers', type=str, help='Search for a subset of identifiers')
+    parser.add_argument('--index', metavar='PATH', type=str, help='A database of previous results to skip unchanged files with')
+    parser.add_argument('-j', '--jobs', nargs='?', const=os.cpu_count(), default=1, type=int, help='Scan directory files in parallel [default: 1, or all cores if no value is given]')
     parser.add_argument('-l', '--list', action='store_true', help='List the supported identifiers')
     parser.add_argument('-p', '--password', nargs='?', const=True, type=str, help='Archive password [default: prompt user]')
     parser.add_argument('-r', '--recursive', action='store_true', help='Scan a directory recursively')
+    parser.add_argument('-s', '--stats', action='store_true', help='Show how much data each prefilter removed from the scan')
     parser.add_argument('-v', '--verbose', action='store_true', help='Show the full lines that matches are found in')
     parser.add_argument('-w', '--wordlist', type=str, help='A file with words to search for, one per line')
     parser.add_argument('file', nargs='?', type=str, help='A file, directory, or archive to scan')
@@ -118,16 +680,29 @@ def main():
     elif args.identifiers:
         regexes = {term: re.compile(identifiers[term].encode('utf-8') if args.binary else identifiers[term], re.MULTILINE) for term in args.identifiers.split(',') if term in identifiers.keys()}
     if args.wordlist:
-        with open(args.wordlist) as wordlist:
-            regex = r'|'.join(wordlist.read().split())
+        with open(args.wordlist) as words:
+            regex = wordlist(words.read().split())
             regexes['words'] = re.compile(regex.encode('utf-8') if args.binary else regex, re.MULTILINE | re.IGNORECASE)
     password = getpass.getpass(prompt='Password: ') if type(args.password) == bool else args.password if type(args.password) == str else ''
     
-    if len(args.file) > 0:
-        if os.path.isdir(args.file):
-            directory(args.file, regexes, args.recursive, args.verbose)
-        elif not archive(args.file, regexes, password, args.verbose):
-            file(args.file, regexes, args.verbose)
+    report = Writer(args.format) if args.format in Writer.formats else generate_report
+    size = args.archive_size * 1024 * 1024
+
+    try:
+        if len(args.file) > 0:
+            if os.path.isdir(args.file):
+                directory(args.file, regexes, args.recursive, args.verbose, args.jobs, args.index, report, password, args.archive_depth, size)
+            else:
+                filetype = sniff(args.file)
+                if filetype[0] in archives:
+                    archive(args.file, regexes, password, args.verbose, args.archive_depth, size, report=report, filetype=filetype)
+                elif not file(args.file, regexes, args.verbose, index=args.index, report=report, filetype=filetype):
+                    print('Skipping file with unsupported type: {}'.format(args.file), file=sys.stderr)
+    finally:
+        if isinstance(report, Writer):
+            report.flush()
+        if args.stats:
+            generate_statistics(regexes.keys())
 
 if __name__ == '__main__':
     main()
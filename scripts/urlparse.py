@@ -4,12 +4,22 @@
 '''URL encoding and decoding.'''
 
 __all__ = [
-    'code', 'encode', 'decode', 'main'
+    'code', 'encode', 'encode_many', 'decode', 'decode_many', 'main'
 ]
 
+import collections
+import functools
+import itertools
+import multiprocessing
+import re
 import sys
 import urllib.parse
 
+# URLs of this form are split by urllib.parse.urlsplit into the same parts as these groups and are rebuilt unchanged by
+# urlunsplit, so they can be transformed without either. Anything else, such as URLs with whitespace, empty queries or
+# fragments, upper case schemes, or IPv6 addresses, is left to urllib.
+simple = re.compile(r'(?:([a-z][a-z0-9+.-]*)://([!$%&\'()*+,\-.0-9:;=@A-Z_a-z~]+)(/[^?#\s]*)?|(/(?!/)[^?#\s]*))(?:\?([^#\s]+))?(?:#(\S+))?\Z')
+
 def code(func, url):
     '''Tranform the the path portion of a URL using the provided function.
 
@@ -20,8 +30,16 @@ def code(func, url):
     :return: The transformed URL
     :rtype: str
     '''
-    parts = urllib.parse.urlsplit(url)
-    return urllib.parse.urlunsplit(parts._replace(path = func(parts.path)))
+    match = simple.match(url)
+    if not match:
+        parts = urllib.parse.urlsplit(url)
+        return urllib.parse.urlunsplit(parts._replace(path = func(parts.path)))
+    scheme, netloc, path, relative, query, fragment = match.groups()
+    path = path or relative or ''
+    coded = func(path)
+    if coded == path:
+        return url
+    return urllib.parse.urlunsplit((scheme or '', netloc or '', coded, query or '', fragment or ''))
 
 def encode(url):
     '''Encodes the path portion of a URL using the %xx escape.
@@ -43,6 +61,67 @@ def decode(url):
     '''
     return code(urllib.parse.unquote_plus, url)
 
+def encode_many(urls, jobs=1):
+    '''Encode the path portion of many URLs, in order. See `encode`.
+
+    :param urls: URLs to encode
+    :type urls: iterable
+    :param jobs: The number of processes to encode chunks of URLs with
+    :type jobs: int, optional
+    :return: A yielded URL
+    :rtype: str
+    '''
+    for chunk in code_chunks(encode, urls, jobs):
+        yield from chunk
+
+def decode_many(urls, jobs=1):
+    '''Decode the path portion of many URLs, in order. See `decode`.
+
+    :param urls: URLs to decode
+    :type urls: iterable
+    :param jobs: The number of processes to decode chunks of URLs with
+    :type jobs: int, optional
+    :return: A yielded URL
+    :rtype: str
+    '''
+    for chunk in code_chunks(decode, urls, jobs):
+        yield from chunk
+
+def code_chunks(func, urls, jobs=1, chunk_size=16384):
+    '''Apply a function to chunks of URLs, on a pool of processes if there is more than one job.
+    Only a few chunks are read ahead of the one being yielded, so memory use does not grow with the input.
+
+    :param func: A function that takes and returns a URL, which must be picklable if there is more than one job
+    :type func: function
+    :param urls: URLs to transform
+    :type urls: iterable
+    :param jobs: The number of processes to use
+    :type jobs: int, optional
+    :param chunk_size: The number of URLs in each chunk
+    :type chunk_size: int, optional
+    :return: A yielded list of transformed URLs, in the same order as the input
+    :rtype: list
+    '''
+    urls = iter(urls)
+    chunks = iter(lambda: list(itertools.islice(urls, chunk_size)), [])
+    if jobs <= 1:
+        yield from (list(map(func, chunk)) for chunk in chunks)
+        return
+    with multiprocessing.Pool(jobs) as pool:
+        pending = collections.deque()
+        for chunk in chunks:
+            pending.append(pool.apply_async(_code_all, (func, chunk)))
+            if len(pending) > jobs * 2:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+def _code_all(func, urls):
+    return list(map(func, urls))
+
+def _code_line(func, url):
+    return ''.join(func(url).split())
+
 def get_urls(files):
     '''Generate a list or URLs from a list of input files or stdin if no files are given.
 
@@ -56,19 +135,22 @@ def get_urls(files):
             yield line.strip()
     else:
         for file in files:
-            with open(file) as _:
-                yield from _.readlines()
+            with open(file, buffering=1024 * 1024) as _:
+                for line in _:
+                    yield line.rstrip('\n')
 
 def main():
     import argparse
+    import os
 
     parser = argparse.ArgumentParser(description='URL encode or decode file(s) or standard input')
     parser.add_argument('-d', '--decode', action='store_true', help='Decode the given URLs')
+    parser.add_argument('-j', '--jobs', nargs='?', const=os.cpu_count(), default=1, type=int, help='Code chunks of URLs in parallel [default: 1, or all cores if no value is given]')
     parser.add_argument('file', nargs='*', help='A file with URLs, one per line')
     args = parser.parse_args()
-    for url in get_urls(args.file):
-        url = decode(url) if args.decode else encode(url)
-        sys.stdout.write(''.join(url.split()) + '\n')
+    # Whitespace is removed in the workers and each chunk is written at once
+    for chunk in code_chunks(functools.partial(_code_line, decode if args.decode else encode), get_urls(args.file), args.jobs):
+        sys.stdout.write('\n'.join(chunk) + '\n')
 
 if __name__ == '__main__':
     try:
@@ -76,4 +158,4 @@ if __name__ == '__main__':
     except BrokenPipeError as _:
         sys.exit(_.errno)
     except KeyboardInterrupt as _:
-        print()
\ No newline at end of file
+        print()
@@ -24,7 +24,7 @@ setuptools.setup(
         'Source Code': 'https://github.com/EvanMcBroom/scripts/tree/master/scripts'
     },
     packages=setuptools.find_packages(where=path),
-    python_requires='>=3.6',
+    python_requires='>=3.7',
     install_requires=install_requires,
     extras_require={
         'dev': ['check-manifest']